@@ -2,71 +2,155 @@
 Example Python code to get non-wear vectors from several published algorithms
 
 If you have a raw .gt3x file, please first use the above code to extract the raw data
+
+The algorithms are independent of each other, so they are executed in parallel processes. The acceleration data is placed in shared memory so it is not copied to each process.
 """
 
 import os
 import numpy as np
-from functions.raw_non_wear_functions import cnn_nw_algorithm, hees_2013_calculate_non_wear_time, raw_baseline_calculate_non_wear_time
-
-# read raw acceleration from numpy array. Since the data was not scaled, we are dividing it by the acceleration scale to obtain acceleration values in gravity units
-raw_acc = np.load(file = os.path.join(os.sep, 'Users', 'shaheen.syed', 'PA', 'acceleration.npz'))['raw_data'] / 256.
-# how to encode wear time
-wt_encoding = 0
-# how to encode non-wear time
-nwt_encoding = 1
-# sample frequency of the data
-hz = 100
-
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+from functions.raw_non_wear_functions import cnn_nw_algorithm, hees_2013_calculate_block_features, hees_2013_calculate_non_wear_time, raw_baseline_calculate_non_wear_time
+
+
+def run_on_shared_memory(algorithm, shm_name, shape, dtype, order = 'C', **kwargs):
+	"""
+	Run a non-wear algorithm on acceleration data that is stored in shared memory (executed within a worker process)
+
+	Parameters
+	----------
+	algorithm : function
+		non-wear algorithm that takes the acceleration data as first argument
+	shm_name : string
+		name of the shared memory block that contains the acceleration data
+	shape : tuple
+		shape of the acceleration data
+	dtype : numpy data type
+		data type of the acceleration data
+	order : string (optional)
+		memory layout of the acceleration data, 'C' (samples stored contiguously) or 'F' (axes stored contiguously)
+	**kwargs : dictionary
+		arguments of the non-wear algorithm
+
+	Returns
+	--------
+	result : object
+		return value of the non-wear algorithm
+	"""
+
+	# attach to the shared memory block
+	shm = shared_memory.SharedMemory(name = shm_name)
+
+	try:
+		# create a numpy array on top of the shared memory, this does not copy the data
+		raw_acc = np.ndarray(shape, dtype = dtype, buffer = shm.buf, order = order)
+		# run the algorithm
+		result = algorithm(raw_acc, **kwargs)
+		# remove the reference to the shared memory so it can be closed
+		del raw_acc
+		return result
+	finally:
+		shm.close()
+
+
+if __name__ == '__main__':
+
+	# read raw acceleration from an uncompressed numpy array as a memory-map so the data is not read into memory at once. If the data is stored in a .npz archive, convert it once
+	# with np.save('acceleration.npy', np.load('acceleration.npz')['raw_data'])
+	raw_data = np.load(file = os.path.join(os.sep, 'Users', 'shaheen.syed', 'PA', 'acceleration.npy'), mmap_mode = 'r')
+	# create a shared memory block that holds the acceleration data as float32, so all processes can read the same data
+	shm = shared_memory.SharedMemory(create = True, size = raw_data.shape[0] * raw_data.shape[1] * np.dtype(np.float32).itemsize)
+	# store the data in Fortran order, so each axis is a contiguous array (structure of arrays) and per-axis calculations (vector magnitude, standard deviation, value range) stream through contiguous memory
+	raw_acc = np.ndarray(raw_data.shape, dtype = np.float32, buffer = shm.buf, order = 'F')
+
+	try:
+		# since the data was not scaled, we are dividing it by the acceleration scale to obtain acceleration values in gravity units. This is done in chunks directly into the shared memory
+		for i in range(0, len(raw_data), 1000000):
+			np.multiply(raw_data[i:i + 1000000], np.float32(1 / 256.), out = raw_acc[i:i + 1000000])
+		# how to encode wear time
+		wt_encoding = 0
+		# how to encode non-wear time
+		nwt_encoding = 1
+		# sample frequency of the data
+		hz = 100
+
+		# description of the shared acceleration data that is sent to the worker processes
+		shared_acc = {'shm_name' : shm.name, 'shape' : raw_acc.shape, 'dtype' : raw_acc.dtype, 'order' : 'F'}
+
+		# use spawned processes, forking a process after tensorflow has been imported is not safe
+		with ProcessPoolExecutor(max_workers = 6, mp_context = get_context('spawn')) as executor:
+
+			# keep track of the name of the algorithm of each task
+			tasks = {}
+
+			"""
+			Get non-wear vector from the CNN non-wear algorithm
+
+			Paper: A novel algorithm to detect non-wear time from raw accelerometer data using convolutional neural networks
+			DOI : https://doi.org/10.1038/s41598-021-87757-z
+			Authors : Shaheen Syed, Bente Morseth, Laila A Hopstock, Alexander Horsch
+			"""
+
+			# path for trained CNN model (best performing cnn model with v2 architecture and 7 seconds window)
+			cnn_model_file = os.path.join('cnn_models', f'cnn_v2_7.h5')
+			# obtain cnn non-wear vector
+			tasks[executor.submit(run_on_shared_memory, cnn_nw_algorithm, **shared_acc, hz = hz, cnn_model_file = cnn_model_file, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)] = 'cnn_nw'
+
+
+			"""
+			Get non-wear vector from v. Hees 2013 non-wear algorithm. Note that the method is identical to the paper published in 2011 but the minimum non-wear time window was increased from 30 to 60 minutes.
+			If you want to apply the 2011 method, simply change the 'min_non_wear_time_window' to 30
+
+			Papers:
+			van Hees, V. T. et al. Estimation of Daily Energy Expenditure in Pregnant and Non-Pregnant Women Using a Wrist-Worn Tri-Axial Accelerometer. PLoS ONE 6, e22922, DOI: 10.1371/journal.pone.0022922 (2011).
+			van Hees, V. T. et al. Separating Movement and Gravity Components in an Acceleration Signal and Implications for the Assessment of Human Daily Physical Activity. PLoS ONE 8, e61691, DOI: 10.1371/journal.pone.0061691 (2013).
+			"""
+
+			# all v. Hees windows below are a multiple of the 15 minutes window overlap, so the block features are calculated once and shared between the calls
+			hees_block_features = hees_2013_calculate_block_features(data = raw_acc, hz = hz, block_size = 15)
+
+			# v. Hees 2011 algorithm
+			tasks[executor.submit(run_on_shared_memory, hees_2013_calculate_non_wear_time, **shared_acc, hz = hz, min_non_wear_time_window = 30, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding, block_features = hees_block_features)] = 'hees_2011_nw'
+			# v. Hees 2013 algorithm
+			tasks[executor.submit(run_on_shared_memory, hees_2013_calculate_non_wear_time, **shared_acc, hz = hz, min_non_wear_time_window = 60, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding, block_features = hees_block_features)] = 'hees_2013_nw'
+
+
+			"""
+			Hees non-wear method with optimized hyperparameters
+
+			Paper: Evaluating the performance of raw and epoch non-wear algorithms using multiple accelerometers and electrocardiogram recordings
+			DOI: https://doi.org/10.1038/s41598-020-62821-2
+			Authors: Shaheen Syed, Bente Morseth, Laila A Hopstock, Alexander Horsch
+			"""
+			# hees non-wear vector with optimized hyperparameters
+			tasks[executor.submit(run_on_shared_memory, hees_2013_calculate_non_wear_time, **shared_acc, hz = hz, min_non_wear_time_window = 135, std_mg_threshold = 7.0, std_min_num_axes = 1, value_range_mg_threshold = 1.0, value_range_min_num_axes = 1, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding, block_features = hees_block_features)] = 'hees_optimized_nw'
+
+
+			"""
+			Best performing baseline non-wear algorithms
+
+			Paper: A novel algorithm to detect non-wear time from raw accelerometer data using convolutional neural networks
+			DOI : https://doi.org/10.1038/s41598-021-87757-z
+			Authors : Shaheen Syed, Bente Morseth, Laila A Hopstock, Alexander Horsch
+			"""
+
+			# XYZ baseline method
+			tasks[executor.submit(run_on_shared_memory, raw_baseline_calculate_non_wear_time, **shared_acc, std_threshold = 0.004, min_interval = 90, hz = hz, use_vmu = False, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)] = 'xyz_nw'
+			# VMY baseline method
+			tasks[executor.submit(run_on_shared_memory, raw_baseline_calculate_non_wear_time, **shared_acc, std_threshold = 0.004, min_interval = 105, hz = hz, use_vmu = True, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)] = 'vmu_nw'
+
 
-"""
-Get non-wear vector from the CNN non-wear algorithm
-
-Paper: A novel algorithm to detect non-wear time from raw accelerometer data using convolutional neural networks
-DOI : https://doi.org/10.1101/2020.07.08.20148015
-Authors : Shaheen Syed, Bente Morseth, Laila A Hopstock, Alexander Horsch
-"""
+			# collect the non-wear vectors as soon as an algorithm has finished
+			non_wear_vectors = {}
+			for task in as_completed(tasks):
+				non_wear_vectors[tasks[task]] = task.result()
 
-# path for trained CNN model (best performing cnn model with v2 architecture and 7 seconds window)
-cnn_model_file = os.path.join('cnn_models', f'cnn_v2_7.h5')
-# obtain cnn non-wear vector
-cnn_nw, _ = cnn_nw_algorithm(raw_acc = raw_acc, hz = hz, cnn_model_file = cnn_model_file, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)
-
-
-"""
-Get non-wear vector from v. Hees 2013 non-wear algorithm. Note that the method is identical to the paper published in 2011 but the minimum non-wear time window was increased from 30 to 60 minutes.
-If you want to apply the 2011 method, simply change the 'min_non_wear_time_window' to 30
-
-Papers:
-van Hees, V. T. et al. Estimation of Daily Energy Expenditure in Pregnant and Non-Pregnant Women Using a Wrist-Worn Tri-Axial Accelerometer. PLoS ONE 6, e22922, DOI: 10.1371/journal.pone.0022922 (2011).
-van Hees, V. T. et al. Separating Movement and Gravity Components in an Acceleration Signal and Implications for the Assessment of Human Daily Physical Activity. PLoS ONE 8, e61691, DOI: 10.1371/journal.pone.0061691 (2013).
-"""
+		# the cnn algorithm also returns the start and stop indexes of the non-wear episodes
+		cnn_nw, _ = non_wear_vectors['cnn_nw']
 
-# v. Hees 2011 algorithm
-hees_2011_nw = hees_2013_calculate_non_wear_time(data = raw_acc, hz = hz, min_non_wear_time_window = 30, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)
-# v. Hees 2013 algorithm
-hees_2013_nw = hees_2013_calculate_non_wear_time(data = raw_acc, hz = hz, min_non_wear_time_window = 60, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)
-
-
-"""
-Hees non-wear method with optimized hyperparameters
-
-Paper: Evaluating the performance of raw and epoch non-wear algorithms using multiple accelerometers and electrocardiogram recordings
-DOI: https://doi.org/10.1038/s41598-020-62821-2
-Authors: Shaheen Syed, Bente Morseth, Laila A Hopstock, Alexander Horsch
-"""
-# hees non-wear vector with optimized hyperparameters
-hees_optimized_nw = hees_2013_calculate_non_wear_time(data = raw_acc, hz = hz, min_non_wear_time_window = 135, std_mg_threshold = 7.0, std_min_num_axes = 1, value_range_mg_threshold = 1.0, value_range_min_num_axes = 1, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)
-
-
-"""
-Best performing baseline non-wear algorithms
-
-Paper: A novel algorithm to detect non-wear time from raw accelerometer data using convolutional neural networks
-DOI : https://doi.org/10.1101/2020.07.08.20148015
-Authors : Shaheen Syed, Bente Morseth, Laila A Hopstock, Alexander Horsch
-"""
+	finally:
 
-# XYZ baseline method
-xyz_nw = raw_baseline_calculate_non_wear_time(raw_acc = raw_acc, std_threshold = 0.004, min_interval = 90, hz = hz, use_vmu = False, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)
-# VMY baseline method
-vmu_nw = raw_baseline_calculate_non_wear_time(raw_acc = raw_acc, std_threshold = 0.004, min_interval = 105, hz = hz, use_vmu = True, nwt_encoding = nwt_encoding, wt_encoding = wt_encoding)
+		# release the shared memory, also when one of the algorithms raised an exception, otherwise the shared memory block is left behind
+		del raw_acc
+		shm.close()
+		shm.unlink()
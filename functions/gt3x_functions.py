@@ -7,8 +7,10 @@ import os
 import logging
 import zipfile
 import numpy as np
-from struct import unpack
-from bitstring import Bits
+from numba import njit, types
+
+# module level logger, messages are formatted lazily so suppressed levels do not pay for string formatting
+logger = logging.getLogger(__name__)
 
 
 def unzip_gt3x_file(f, save_location = None, delete_source_file = False):
@@ -51,7 +53,7 @@ def unzip_gt3x_file(f, save_location = None, delete_source_file = False):
 				myzip.extractall(save_location)
 				
 		except Exception as e:
-			logging.error('Error unpacked file: {}'.format(e))
+			logger.error('Error unpacked file: %s', e)
 			return None, None
 		
 		finally:
@@ -59,7 +61,7 @@ def unzip_gt3x_file(f, save_location = None, delete_source_file = False):
 			if delete_source_file:
 				os.remove(f)
 	else:
-		logging.debug('file already unpacked: {}'.format(f))
+		logger.debug('file already unpacked: %s', f)
 
 	# create the path locations where the log.bin and info.txt files are stored
 	log_bin = os.path.join(save_location, 'log.bin')
@@ -106,7 +108,7 @@ def extract_info(info_txt):
 				# add to dictionary and replace key values with space in key with underscore
 				info_data[key.replace(' ', '_')] = value
 	except Exception as e:
-		logging.error('Error extracting data from info.txt file: {}'.format(e))	
+		logger.error('Error extracting data from info.txt file: %s', e)	
 		exit(1)
 	
 	# return dictionary
@@ -116,7 +118,7 @@ def extract_info(info_txt):
 def extract_log(log_bin, acceleration_scale, sample_rate, use_scaling = False):
 	"""
 	Extract acceleration data from log.bin file that was unzipped from the raw .gt3x file
-	One second of raw activity samples packed into 12-bit values in YXZ order.
+	Each activity record contains one second of raw activity samples, packed into 12-bit values in YXZ order (ACTIVITY) or stored as 16-bit values in XYZ order (ACTIVITY2).
 	
 	Parameters
 	----------
@@ -139,134 +141,52 @@ def extract_log(log_bin, acceleration_scale, sample_rate, use_scaling = False):
 	Returns
 	---------
 	log_data : numpy array (time steps * sample_rate, num axes)
-		log data contains the raw acceleration values in YXZ order
+		log data contains the raw acceleration values in XYZ order
 	log_time : numpy array (time steps, 1)
 		log time contains the timestamps of measurements
 	"""
 
-	# define the size of the payload. This is necessary because we need to define the size of the numpy array before we populate it. -1 because we start counting from 0
-	SIZE = count_payload_size(log_bin) - 1
-	# raw data values are stored in ints, to obtain values in G, we need to scale them by a factor found in the acceleration_scale parameter within the info.txt file. For example, 256.0
-	SCALING = 1 / acceleration_scale
-	# counter so we can keep track of how many acceleration values we have processed
-	COUNTER = 0
 	# number of axes, the GTX3 is tri-axial, so we hard code it here.
 	NUM_AXES = 3
 
-	# empty dictionary where we can store the 12bit to signed integer values; this saves calculating them all the time
-	bit12_to_int = {}
+	try:
 
-	"""
-		create empty numpy array where we can store the acceleration data to: dimensions (sample_rate x SIZE,number of axis)
-		if we want to scale the values to floats, we need a bigger datatype, it would take more memory. If no scaling is necessary, because we can scale later during preprocessing or so, we can
-		proceed with just an int8 datatype array.
-		For example, without scaling, 7 days of data equals around 180MB, with scaling the numpy array equals around 1.5GB
-	"""
+		# memory-map the log.bin file as an array of bytes, so the operating system reads the bytes from disk while they are counted and decoded instead of reading the whole file into memory first.
+		# Note that np.asarray makes sure the memory-map is passed to the compiled functions as a plain numpy array
+		log_bytes = np.memmap(log_bin, dtype=np.uint8, mode='r')
 
-	# use int16 as datatype to store the signed integer values, this saves memory when saving the array
-	acc_data_type = np.int16
-	if use_scaling:
-		# use float when we want to store the acceleration data in G, meaning that we the scaling factor to recalculate the signed int into decimal values
-		acc_data_type = np.float
-	# create empty array for the acceleration data
-	log_data = np.empty((sample_rate * SIZE , NUM_AXES), dtype=acc_data_type)
-	# empty numpy array to store the timestamps
-	time_data = np.empty((SIZE,1), dtype=np.uint32)
+		# define the size of the payload, i.e. the number of ACTIVITY (type 0) and ACTIVITY2 (type 26) records. This is necessary because we need to define the size of the numpy array before we populate it.
+		# The records are counted on the same memory-map, so the log.bin file is only opened once
+		SIZE = _count_log_records(np.asarray(log_bytes), 0) + _count_log_records(np.asarray(log_bytes), 26)
 
-	# open the log.bin file in binary mode
-	with open(log_bin, mode='rb') as file:
+		# use int16 as datatype to store the signed integer values, this saves memory when saving the array. If scaling is necessary, the values are scaled after all data has been read
+		# for example, without scaling, 7 days of data equals around 180MB, with scaling the numpy array equals around 1.5GB
+		log_data = np.empty((sample_rate * SIZE , NUM_AXES), dtype=np.int16)
+		# empty numpy array to store the timestamps
+		time_data = np.empty((SIZE,1), dtype=np.uint32)
 
-		try:
+		# decode all activity records from the bytes in a single pass (executed as compiled numba code). The values are stored in XYZ order for both record types
+		COUNTER = _decode_log(np.asarray(log_bytes), sample_rate, SIZE, log_data, time_data)
 
-			# keep reading byte by byte
-			while True:
-
-				"""
-				Log Record Format
-				Offset (bytes)	Size (bytes)	Name	Description	Part of Record
-				0	1	Seperator	An ASCII record separator byte (1Eh) marks the beginning of each log record.	Header
-				1	1	Type	A type identifier is used to interpret the payload of the record.	Header
-				2	4	Timestamp	The date and time of the data contained in the record are marked to the nearest second in Unix time format.	Header
-				6	2	Size	The size of the payload is given in bytes as an little-endian unsigned integer.	Header
-				"""
-				_, payload_type, timestamp, size  = unpack("<cbLH", file.read(8))
-
-				# acceleration type 0 is the activity data, we skip all other data but can easily be read with an if statement
-				if payload_type == 0:
-
-					"""
-						This is the actual data that varies based on the record *Type* field. It's size is provided in the *Size* field. Please refer to the appropriate section for the record type for the indiviual payload formats.
-					
-
-						read the payload in bits (the reason we are converting the bytes to bits is that 1 acceleration value is encoded in 12bit, so we can cut out 12 bits at a time from the full payload represented as individual bits)
-						basically the YXZ (3 axis) is 12 bit + 12 bit + 12 bit = 36 bits. When we have 100hz, we have a total of 36 * 100 = 3600 bits. When you look at the size of the payload in bytes, that is for instance 450 bytes, you can
-						see that this is also 450 * 8 = 3600 bits
-					"""
-
-					# read the bytes as bits as a large string
-					payload_bits = Bits(bytes = file.read(size)).bin
-
-					# extract 12 bits as 1 acceleration value and add them to a list
-					bits_list = []
-					for i in range(0,len(payload_bits),12):
-						
-						# extract the 12 bit as a string
-						bitstring = payload_bits[i:i+12]
-
-						# convert to 12bit two's complement to signed integer value: also store values in dictionary for faster reading if not already present (the Bits function is not as fast as reading it from a dictionary)
-						if bitstring not in bit12_to_int:
-							# convert 12bit to signed integer
-							acc_value = Bits(bin=bitstring).int
-							# add to dictionary so we can read it faster next time we have the same value
-							bit12_to_int[bitstring] = acc_value
-						else:
-							# bitstring previously already converted to signed int, so we can obtain it from the dictionary
-							acc_value = bit12_to_int[bitstring]
-
-						# add to list 
-						bits_list.append(acc_value)
-
-					# convert list to numpy array and perform scaling if it was set to True: no scaling allows for a smaller numpy array because we can use int8 and not need the float
-					if use_scaling:
-						payload_bits_array = np.array(bits_list).reshape(sample_rate,NUM_AXES) * SCALING
-					else:
-						payload_bits_array = np.array(bits_list).reshape(sample_rate,NUM_AXES)
-
-					# add payload bits array to overall numpy array
-					np_start = COUNTER * sample_rate
-					np_end = np_start + sample_rate
-					log_data[np_start:np_end] = payload_bits_array
-					
-					# add the time component
-					time_data[COUNTER] = timestamp
-					
-					# increase the counter
-					COUNTER +=1
+		# close the memory-map, so the log.bin file can be deleted afterwards
+		del log_bytes
 
-				else:
-					# skip whatever is not acceleration data
-					# there are different payload types and can easily be read by adding a different payload_type in this section
-					file.seek(size, 1)
+		# the decoder returns -1 when the log.bin file could not be decoded (for instance, a truncated file or an unexpected payload size)
+		if COUNTER != SIZE:
+			raise ValueError(f'could only decode {max(COUNTER, 0)} of {SIZE} activity records')
 
-				"""
-				A 1-byte checksum immediately follows the record payload. It is a 1's complement, exclusive-or (XOR) of the log header and payload with an initial value of zero.
+		logger.info('Finished processing activity data')
 
-				TODO: calculate checksum from payload and header and see if it matches the checksum that we read from the last byte
-				"""	
-				_ = unpack("B", file.read(1))
-
-				# stop when all records have been read
-				if COUNTER == SIZE:
+	except Exception as e:
+		logger.error('Unpacking GTX3 exception: %s', e)
+		return None, None
 
-					logging.info('Finished processing activity data')
-					break
-		
-		except Exception as e:
-			logging.error('Unpacking GTX3 exception: {}'.format(e))
-			return None, None
+	# use float when we want to store the acceleration data in G, meaning that we the scaling factor to recalculate the signed int into decimal values
+	if use_scaling:
+		log_data = rescale_log_data(log_data, acceleration_scale)
 
-		# return acceleration data + time data
-		return log_data, time_data
+	# return acceleration data + time data
+	return log_data, time_data
 
 
 def count_payload_size(log_bin, count_payload = 0):
@@ -280,7 +200,8 @@ def count_payload_size(log_bin, count_payload = 0):
 	log_bin : string
 		location of the log.bin file on disk
 	count_payload : int (optional)
-		the payload type that we want to count. default is 0, which is the acceleration data.
+		the payload type that we want to count. default is 0, which is the acceleration data (ACTIVITY). Newer devices store the acceleration data in type 26 (ACTIVITY2) records.
+		Records with a payload of less than 2 bytes do not contain acceleration data (e.g. an ACTIVITY2 record when the device is in idle sleep mode) and are not counted
 
 	Returns
 	---------
@@ -288,41 +209,26 @@ def count_payload_size(log_bin, count_payload = 0):
 		the size (as in count) of the payload
 	"""
 
-	# define size variable
-	SIZE = 0
+	# an empty file can not be memory-mapped, and contains no records
+	if os.path.getsize(log_bin) == 0:
+		return 0
 
-	# open the log.bin file in binary mode
-	with open(log_bin, mode='rb') as file:
-		
-		try:
-		# keep reading byte by byte
-			while True:
+	# memory-map the log.bin file as an array of bytes
+	log_bytes = np.memmap(log_bin, dtype=np.uint8, mode='r')
 
-				# extract header information
-				_, payload_type, _, size  = unpack("<cbLH", file.read(8))
+	# count the records in a single pass over the record headers (executed as compiled numba code)
+	SIZE = _count_log_records(np.asarray(log_bytes), count_payload)
 
-				# count payload 
-				if payload_type == count_payload:
+	# close the memory-map
+	del log_bytes
 
-					# skip the byte content, we don't need to process it here
-					file.seek(size,1)
-					# increment counter
-					SIZE +=1
-				else:
-					# skip other payload types, we don't need to read it here
-					file.seek(size,1)
+	logger.info('Counted payload size: %s', SIZE)
 
-				# skip the 1-byte checksum value
-				file.seek(1,1)
-	
-		except:
-		
-			logging.info('Counted payload size: {}'.format(SIZE))
-			# return the value
-			return SIZE
+	# return the value
+	return SIZE
 
 
-def rescale_log_data(log_data, acceleration_scale = 256.):
+def rescale_log_data(log_data, acceleration_scale = 256., order = 'C'):
 	"""
 	Rescale raw acceleration data to g values
 
@@ -332,11 +238,13 @@ def rescale_log_data(log_data, acceleration_scale = 256.):
 		array with YXZ acceleration data (in integers otherwise no scaling required)
 	acceleration_scale : float (optional)
 		value to scale the acceleration
+	order : string (optional)
+		memory layout of the scaled data, 'C' (samples stored contiguously) or 'F' (axes stored contiguously, so per-axis calculations such as the standard deviation read contiguous memory)
 
 	Returns
 	-------
 	scaled_log_data : np.array()
-		log_data scaled by acceleration scale
+		log_data scaled by acceleration scale (float32)
 	"""
 
 	try:
@@ -344,10 +252,19 @@ def rescale_log_data(log_data, acceleration_scale = 256.):
 		# calculate the scaling factor
 		scale_factor = 1. / float(acceleration_scale)
 
-		# apply scaling and return
-		return log_data * scale_factor
+		# create the float32 array for the scaled data, float32 is the data type the non-wear algorithms and the CNN model work with. The precision of float32 (24 bits) is more than enough for the
+		# 12 bit values of the accelerometer (a resolution of about 4 mg at 256 LSB/g), so no meaningful precision is lost and the memory is halved compared to float64
+		scaled_log_data = np.empty(log_data.shape, dtype = np.float32, order = order)
+
+		# acceleration data (samples x axes) is converted and scaled in a single pass, without a temporary float64 array. Note that np.asarray makes sure a memory-mapped array is passed as a plain numpy array
+		if log_data.ndim == 2:
+			_rescale_log_data(np.asarray(log_data), scale_factor, scaled_log_data)
+		else:
+			np.multiply(log_data, scale_factor, out = scaled_log_data, casting = 'same_kind')
+
+		return scaled_log_data
 	except Exception as e:
-		logging.error('Error rescaling log data: {}'.format(e))
+		logger.error('Error rescaling log data: %s', e)
 		exit(1)
 
 
@@ -372,7 +289,7 @@ def create_time_array(time_data, hz = 100):
 
 	# check if the sampling frequenzy can fit into equal parts within a 1000ms window
 	if 1000 % hz != 0:
-		logging.error('Sampling frequenzy {} cannot be split into equal parts within a 1s window'.format(hz))
+		logger.error('Sampling frequenzy %s cannot be split into equal parts within a 1s window', hz)
 		exit(1)
 
 	# calculate the step size of hz in 1s (so 100hz means 100 measurements in 1sec, so if we need to fill 1000ms then we need use a step size of 10)
@@ -384,4 +301,222 @@ def create_time_array(time_data, hz = 100):
 	# flatten the array 
 	time_data = time_data.flatten()
 
-	return time_data
\ No newline at end of file
+	return time_data
+
+
+
+def get_sample_timestamps(time_data, indexes, hz = 100):
+	"""
+	Get the timestamps of individual samples, this gives the same timestamps as create_time_array(time_data, hz)[indexes] but without creating the time array of all samples
+	(which takes 8 bytes per sample). The time data can therefore stay memory-mapped, only the seconds of the requested samples are read
+
+	Parameters
+	---------
+	time_data : np.array
+		numpy array containing unix timestamps of each second (obtained by reading the raw .gt3x data)
+	indexes : np.array
+		sample indexes to get the timestamps of (any shape)
+	hz : int (optional)
+		sampling frequency of the acceleration data
+
+	Returns
+	--------
+	timestamps : np.array
+		timestamp (datetime64[ms]) of each sample index, with the same shape as indexes
+	"""
+
+	# check if the sampling frequenzy can fit into equal parts within a 1000ms window
+	if 1000 % hz != 0:
+		logger.error('Sampling frequenzy %s cannot be split into equal parts within a 1s window', hz)
+		exit(1)
+
+	# sample indexes as integers
+	indexes = np.asarray(indexes, dtype = np.int64)
+
+	# read the unix timestamps of the seconds the samples belong to, and convert them to 64 bit milliseconds
+	timestamps = np.asarray(np.asarray(time_data).ravel()[indexes // hz], dtype = 'datetime64[s]').astype('datetime64[ms]')
+
+	# add the milliseconds of the sample within its second
+	return timestamps + ((indexes % hz) * (1000 // hz)).astype('timedelta64[ms]')
+
+"""
+	INTERNAL HELPER FUNCTIONS
+"""
+
+@njit(cache = True, fastmath = True, nogil = True)
+def _rescale_log_data(log_data, scale_factor, out):
+	"""
+	Scale raw acceleration data to g values in a single pass. Executed as compiled numba code without holding the GIL, so data can be rescaled in a background thread.
+	Note that this is deliberately not a parallel kernel, not all numba threading layers support launching parallel kernels from several threads at once
+
+	Parameters
+	----------
+	log_data : np.array((n_samples, n_axes))
+		array with raw acceleration data
+	scale_factor : float
+		value to multiply the acceleration data with (1 / acceleration scale)
+	out : np.array((n_samples, n_axes))
+		array to store the scaled acceleration data in
+	"""
+
+	for i in range(log_data.shape[0]):
+		for j in range(log_data.shape[1]):
+			out[i, j] = log_data[i, j] * scale_factor
+
+
+# the data types of the arguments are always the same (the bytes are read-only since they are memory-mapped), so the function is compiled (or loaded from the cache) when the module is imported
+@njit(types.int64(types.Array(types.uint8, 1, 'C', readonly = True), types.int64), cache = True, nogil = True)
+def _count_log_records(log_bytes, payload_type):
+	"""
+	Count the records of a payload type in a log.bin file by jumping from record header to record header (see _decode_log for the log record format). Executed as compiled numba code without holding the GIL.
+	Records with a payload of less than 2 bytes do not contain acceleration data and are not counted
+
+	Parameters
+	----------
+	log_bytes : np.array(n_bytes)
+		content of the log.bin file (uint8)
+	payload_type : int
+		the payload type that we want to count, for instance 0 (ACTIVITY) or 26 (ACTIVITY2)
+
+	Returns
+	--------
+	count : int
+		number of records of the payload type
+	"""
+
+	# position of the current record in the bytes
+	i = 0
+	# number of counted records
+	count = 0
+
+	# stop when the header of the next record is not complete
+	while i + 8 <= log_bytes.shape[0]:
+
+		# read the payload size (little-endian unsigned 16 bit) from the header
+		payload_size = np.int64(log_bytes[i + 6]) | (np.int64(log_bytes[i + 7]) << 8)
+
+		# count the record
+		if log_bytes[i + 1] == payload_type and payload_size >= 2:
+			count += 1
+
+		# skip the header, the payload, and the 1-byte checksum
+		i += 8 + payload_size + 1
+
+	return count
+
+
+# the data types of the arguments are always the same (the bytes are read-only since they are memory-mapped), so the function is compiled (or loaded from the cache) when the module is imported
+@njit(types.int64(types.Array(types.uint8, 1, 'C', readonly = True), types.int64, types.int64, types.int16[:, ::1], types.uint32[:, ::1]), cache = True, nogil = True)
+def _decode_log(log_bytes, sample_rate, size, log_data, time_data):
+	"""
+	Decode the activity records of a log.bin file. Executed as compiled numba code without holding the GIL
+
+	Log Record Format
+	Offset (bytes)	Size (bytes)	Name	Description	Part of Record
+	0	1	Seperator	An ASCII record separator byte (1Eh) marks the beginning of each log record.	Header
+	1	1	Type	A type identifier is used to interpret the payload of the record.	Header
+	2	4	Timestamp	The date and time of the data contained in the record are marked to the nearest second in Unix time format.	Header
+	6	2	Size	The size of the payload is given in bytes as an little-endian unsigned integer.	Header
+
+	The header is followed by the payload and a 1-byte checksum. The payload of an ACTIVITY record (type 0) contains one second of raw activity samples packed into 12-bit two's complement values in YXZ order.
+	So, 3 axis is 12 bit + 12 bit + 12 bit = 36 bits per sample, and a payload of 450 bytes (3600 bits) contains 100 samples. The payload of an ACTIVITY2 record (type 26) contains one second of samples as 
+	little-endian signed 16-bit values in XYZ order. Records with a payload of less than 2 bytes contain no samples (idle sleep mode) and are skipped
+
+	Parameters
+	----------
+	log_bytes : np.array(n_bytes)
+		content of the log.bin file (uint8)
+	sample_rate : int
+		sample rate, i.e. the number of Hz (how many values we obtain per second)
+	size : int
+		number of activity records to decode
+	log_data : np.array((sample_rate * size, 3))
+		array to store the acceleration values in (XYZ order)
+	time_data : np.array((size, 1))
+		array to store the timestamps of the activity records in
+
+	Returns
+	--------
+	counter : int
+		number of decoded activity records, or -1 if the bytes could not be decoded
+	"""
+
+	# position of the current record in the bytes
+	i = 0
+	# counter so we can keep track of how many activity records we have processed
+	counter = 0
+
+	while counter < size:
+
+		# stop if the header of the record is not complete
+		if i + 8 > log_bytes.shape[0]:
+			return -1
+
+		# read the type, timestamp (little-endian unsigned 32 bit), and payload size (little-endian unsigned 16 bit) from the header
+		payload_type = log_bytes[i + 1]
+		timestamp = np.uint32(log_bytes[i + 2]) | (np.uint32(log_bytes[i + 3]) << 8) | (np.uint32(log_bytes[i + 4]) << 16) | (np.uint32(log_bytes[i + 5]) << 24)
+		payload_size = np.int64(log_bytes[i + 6]) | (np.int64(log_bytes[i + 7]) << 8)
+
+		# start of the payload
+		i += 8
+
+		# acceleration type 0 is the activity data (ACTIVITY), we skip all other data
+		if payload_type == 0 and payload_size >= 2:
+
+			# the payload needs to contain exactly 'sample_rate' samples of 3 axes with 12 bits each, and needs to be complete
+			if payload_size * 8 != sample_rate * 3 * 12 or i + payload_size > log_bytes.shape[0]:
+				return -1
+
+			for v in range(sample_rate * 3):
+
+				# the 12 bit value starts at the beginning (even values) or in the middle (odd values) of a byte
+				j = i + (v * 3) // 2
+				if v % 2 == 0:
+					value = (np.int32(log_bytes[j]) << 4) | (np.int32(log_bytes[j + 1]) >> 4)
+				else:
+					value = ((np.int32(log_bytes[j]) & 0x0F) << 8) | np.int32(log_bytes[j + 1])
+
+				# convert 12 bit two's complement to signed integer value
+				if value >= 2048:
+					value -= 4096
+
+				# the values are stored in YXZ order, swap the first two axes to store them in XYZ order
+				axis = v % 3
+				if axis < 2:
+					axis = 1 - axis
+
+				log_data[counter * sample_rate + v // 3, axis] = value
+
+			# add the time component
+			time_data[counter, 0] = timestamp
+
+			# increase the counter
+			counter += 1
+
+		# acceleration type 26 is the activity data of newer devices (ACTIVITY2)
+		elif payload_type == 26 and payload_size >= 2:
+
+			# the payload needs to contain exactly 'sample_rate' samples of 3 axes with 16 bits each, and needs to be complete
+			if payload_size != sample_rate * 3 * 2 or i + payload_size > log_bytes.shape[0]:
+				return -1
+
+			for v in range(sample_rate * 3):
+
+				# little-endian signed 16 bit value
+				j = i + v * 2
+				value = np.int32(log_bytes[j]) | (np.int32(log_bytes[j + 1]) << 8)
+				if value >= 32768:
+					value -= 65536
+
+				log_data[counter * sample_rate + v // 3, v % 3] = value
+
+			# add the time component
+			time_data[counter, 0] = timestamp
+
+			# increase the counter
+			counter += 1
+
+		# skip the payload and the 1-byte checksum
+		i += payload_size + 1
+
+	return counter
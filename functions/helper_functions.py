@@ -2,14 +2,29 @@
 	IMPORT PACKAGES
 """
 import logging
+import logging.handlers
+import atexit
 import time
-import psutil
 import os
 import sys
-import glob2
+import glob
+import math
 import numpy as np
 import csv
 from datetime import datetime
+from numba import njit, prange
+# the resource module is only available on unix systems, on Windows we fall back to psutil to obtain the memory usage
+try:
+	import resource
+except ImportError:
+	resource = None
+	import psutil
+
+# module level logger, messages are formatted lazily so suppressed levels do not pay for string formatting
+logger = logging.getLogger(__name__)
+
+# format of the log messages, created once and shared by all handlers
+_formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
 
 def set_logger(folder_name = 'logs'):
 	"""
@@ -29,32 +44,47 @@ def set_logger(folder_name = 'logs'):
 	# create the logging folder if not exists
 	create_directory(folder_name)
 
-	# define the name of the log file
-	log_file_name = os.path.join(folder_name, '{:%Y%m%d%H%M%S}.log'.format(datetime.now()))
-
 	# create a new logger but use root
 	logger = logging.getLogger('')
 
-	# clear existing handlers to avoid duplicated output
-	logger.handlers.clear()
-
 	# set logging level, DEBUG means everything, also INFO, WARNING, EXCEPTION, ERROR etc
 	logger.setLevel(logging.DEBUG)
 
-	# define the format of the message
-	formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+	# if the logger was already set up to write to this folder, reuse the existing handlers instead of creating new ones (and a new log file) on every call
+	for handler in logger.handlers:
+		# the file handler is wrapped in a memory handler
+		file_handler = getattr(handler, 'target', handler)
+		if isinstance(file_handler, logging.FileHandler) and os.path.dirname(file_handler.baseFilename) == os.path.abspath(folder_name):
+			return logger
+
+	# close and remove existing handlers (and the file handlers they write to) to avoid duplicated output and open file handles
+	for handler in logger.handlers:
+		file_handler = getattr(handler, 'target', None)
+		handler.close()
+		if file_handler is not None:
+			file_handler.close()
+	logger.handlers.clear()
+
+	# define the name of the log file
+	log_file_name = os.path.join(folder_name, '{:%Y%m%d%H%M%S}.log'.format(datetime.now()))
+
+	# write log to filehandler, the file is only opened when the first record is written
+	file_handler = logging.FileHandler(log_file_name, delay = True)
+	file_handler.setFormatter(_formatter)
 
-	# write log to filehandler
-	file_handler = logging.FileHandler(log_file_name)
-	file_handler.setFormatter(formatter)
+	# buffer the log records in memory and write them to the file in batches, errors are written immediately
+	memory_handler = logging.handlers.MemoryHandler(capacity = 10000, flushLevel = logging.ERROR, target = file_handler)
+
+	# make sure the buffered records are written to the file when the program exits
+	atexit.register(memory_handler.flush)
 
 	# write to console
 	stream_handler = logging.StreamHandler()
-	stream_handler.setFormatter(formatter)
+	stream_handler.setFormatter(_formatter)
 
-	# add stream handler and file handler to logger
+	# add stream handler and buffered file handler to logger
 	logger.addHandler(stream_handler)
-	logger.addHandler(file_handler)
+	logger.addHandler(memory_handler)
 	
 	return logger
 
@@ -69,7 +99,7 @@ def set_start():
 	tic : timestamp
 		time the program starts
 	process : object
-		process id
+		process id (only used on systems without the resource module, otherwise None)
 	logger : logging object
 		logger that outputs to console and save log file to disk
 	"""
@@ -80,8 +110,8 @@ def set_start():
 	# define start time
 	tic = time.time()
 
-	# define process ID
-	process = psutil.Process(os.getpid())
+	# define process ID, only needed when the peak memory cannot be read with a single getrusage call
+	process = psutil.Process(os.getpid()) if resource is None else None
 
 	return tic, process, logger
 
@@ -94,11 +124,20 @@ def set_end(tic, process):
 	----------
 	tic : timestamp
 		time the program has started
+	process : object
+		process id as returned by set_start (only used on systems without the resource module)
 	"""
 
 	# print time elapsed
-	logging.info('-- executed in {} seconds'.format(time.time()-tic))
-	logging.info('-- used {} MB of memory'.format(process.memory_info().rss / 1024 / 1024))
+	logger.info('-- executed in %s seconds', time.time()-tic)
+
+	if resource is not None:
+		# peak memory of the process with a single system call. Note that ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+		max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		max_rss_mb = max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+		logger.info('-- used %s MB of memory (peak)', max_rss_mb)
+	else:
+		logger.info('-- used %s MB of memory', process.memory_info().rss / 1024 / 1024)
 
 
 def create_directory(name):
@@ -114,13 +153,13 @@ def create_directory(name):
 	try:
 		if not os.path.exists(name):
 			os.makedirs(name)
-			logging.info('Created directory: {}'.format(name))
+			logger.info('Created directory: %s', name)
 	except Exception as e:
-		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		logger.error('[%s] : %s', sys._getframe().f_code.co_name, e)
 		exit(1)
 
 
-def read_directory(directory):
+def read_directory(directory, pattern = '*.*'):
 
 	"""
 	Read file names from directory recursively
@@ -129,21 +168,24 @@ def read_directory(directory):
 	----------
 	directory : string
 		directory/folder name where to read the file names from
+	pattern : string (optional)
+		glob pattern that the file names need to match, for example '*.gt3x'. Files are filtered while the directory is traversed, so no list of all files
+		needs to be created and filtered afterwards. Default '*.*' (all files with an extension)
 
 	Returns
 	---------
-	files : list of strings
-		list of file names
+	files : generator of strings
+		generator that yields the file names while the directory is traversed
 	"""
 	
 	try:
-		return glob2.glob(os.path.join( directory, '**' , '*.*'))
+		return glob.iglob(os.path.join( directory, '**' , pattern), recursive = True)
 	except Exception as e:
-		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		logger.error('[%s] : %s', sys._getframe().f_code.co_name, e)
 		exit(1)
 
 
-def calculate_vector_magnitude(data, minus_one = False, round_negative_to_zero = False, dtype = np.float32):
+def calculate_vector_magnitude(data, minus_one = False, round_negative_to_zero = False, dtype = np.float32, out = None):
 	"""
 	Calculate vector magnitude of acceleration data
 	the vector magnitude of acceleration is calculated as the Euclidian Norm
@@ -164,6 +206,8 @@ def calculate_vector_magnitude(data, minus_one = False, round_negative_to_zero =
 		If set to True, round negative values to zero
 	dtype = mumpy data type (optional)
 		set the data type of the return array. Standard float 16, but can be set to better precision
+	out : numpy array (acceleration values, 1) (optional)
+		array to store the vector magnitude in, so the same memory can be reused for successive calls. If not given, a new array of data type 'dtype' is created
 	
 	Returns
 	-------
@@ -172,28 +216,53 @@ def calculate_vector_magnitude(data, minus_one = False, round_negative_to_zero =
 	"""
 
 	# change dtype of array to float32 (also to hold scaled data correctly). The original unscaled data is stored as int16, but when we want to calculate the vector we exceed the values that can be stored in 16 bit
-	data = data.astype(dtype = np.float32)
+	# data that is already float32 is used as is, so only other data types (e.g. int16) pay for the copy
+	data = data.astype(dtype = np.float32, copy = False)
 
 	try:
 
-		# calculate the vector magnitude on the whole array
-		vector_magnitude = np.sqrt(np.sum(np.square(data), axis=1)).astype(dtype=dtype)
+		# create the array of number of acceleration values, 1 column to store the vector magnitude in
+		if out is None:
+			out = np.empty((data.shape[0], 1), dtype = dtype)
+
+		# all calculations are done in-place on a view of the single column, so no temporary arrays are created
+		vector_magnitude = out[:, 0]
+
+		# the ENMO of triaxial data is calculated in a single fused pass (square root, minus one, and rounding), instead of three passes over the vector magnitude array
+		if data.shape[1] == 3 and minus_one:
+
+			_calculate_enmo(data[:,0], data[:,1], data[:,2], round_negative_to_zero, vector_magnitude)
+
+			return out
+
+		# check if the data is triaxial
+		if data.shape[1] == 3:
+
+			# calculate the vector magnitude as hypot(hypot(x, y), z). Hypot scales internally so it does not overflow or underflow, and it avoids a temporary array with squared values
+			np.hypot(data[:,0], data[:,1], out = vector_magnitude)
+			np.hypot(vector_magnitude, data[:,2], out = vector_magnitude)
+
+		else:
+
+			# calculate the sum of squares of each row as a fused row-wise dot product (this avoids allocating a temporary array with all squared values)
+			np.einsum('ij,ij->i', data, data, out = vector_magnitude, casting = 'same_kind')
+			# calculate the vector magnitude on the whole array by taking the square root in-place
+			np.sqrt(vector_magnitude, out = vector_magnitude)
 
 		# check if minus_one is set to True, if so, we need to calculate the ENMO
 		if minus_one:
-			vector_magnitude -= 1
+			np.subtract(vector_magnitude, 1, out = vector_magnitude)
 
 		# if set to True, round negative values to zero
 		if round_negative_to_zero:
-			vector_magnitude = vector_magnitude.clip(min=0)
+			np.maximum(vector_magnitude, 0, out = vector_magnitude)
 
-		# reshape the array into number of acceleration values, 1 column
-		return vector_magnitude.reshape(data.shape[0], 1)
+		return out
 		
 
 	except Exception as e:
 		
-		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		logger.error('[%s] : %s', sys._getframe().f_code.co_name, e)
 		exit(1)
 
 
@@ -203,8 +272,8 @@ def save_csv(data, name, folder):
 
 	Parameters
 	----------
-	data : list of list
-		A list of lists that contain data to be stored into a CSV file format
+	data : list of list or np.array
+		A list of lists (or 2D numpy array) that contain data to be stored into a CSV file format
 	name : string
 		The name of the file you want to give it
 	folder: string
@@ -224,11 +293,83 @@ def save_csv(data, name, folder):
 		# create the file name
 		path = os.path.join(folder, name)
 
+		# convert numpy array to list of lists in one go. The csv writer converts python scalars to strings much faster than numpy scalars (np.savetxt also formats row by row in python, and is slower,
+		# and pandas' to_csv writes the same output but is not faster for integer indexes and is slower for timestamp strings and floats)
+		if isinstance(data, np.ndarray):
+			data = data.tolist()
+
 		# save data to folder with name
 		with open(path, "w") as f:
 			writer = csv.writer(f, lineterminator='\n')
 			writer.writerows(data)
 
 	except Exception as e:
-		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		logger.error('[%s] : %s', sys._getframe().f_code.co_name, e)
 		exit(1)
+
+
+def save_npy(data, name, folder):
+	"""
+	Save data as binary numpy file (.npy). This is much faster than saving to CSV when the data does not need to be human readable
+
+	Parameters
+	----------
+	data : list of list or np.array
+		data to be stored into a numpy file
+	name : string
+		The name of the file you want to give it
+	folder: string
+		The folder location
+	"""
+	
+	try:
+
+		# create folder name as directory if not exists
+		create_directory(folder)
+
+		# create the path name (allows for .npy and no .npy extension to be handled correctly)
+		suffix = '.npy'
+		if name[-4:] != suffix:
+			name += suffix
+
+		# save data to folder with name
+		np.save(os.path.join(folder, name), np.asarray(data))
+
+	except Exception as e:
+		logger.error('[%s] : %s', sys._getframe().f_code.co_name, e)
+		exit(1)
+
+
+"""
+	INTERNAL HELPER FUNCTIONS
+"""
+
+@njit(parallel = True, fastmath = True, cache = True)
+def _calculate_enmo(x, y, z, round_negative_to_zero, out):
+	"""
+	Calculate the ENMO (Euclidian Norm Minus One) of triaxial acceleration data in a single pass. Executed as compiled numba code in parallel
+
+	Parameters
+	----------
+	x : np.array(n_samples)
+		acceleration values of the first axis
+	y : np.array(n_samples)
+		acceleration values of the second axis
+	z : np.array(n_samples)
+		acceleration values of the third axis
+	round_negative_to_zero : Boolean
+		If set to True, round negative values to zero
+	out : np.array(n_samples)
+		array to store the ENMO values in
+	"""
+
+	for i in prange(out.shape[0]):
+
+		# calculate the vector magnitude minus one with double precision
+		value = math.sqrt(float(x[i]) * x[i] + float(y[i]) * y[i] + float(z[i]) * z[i]) - 1.0
+
+		# round negative values to zero
+		if round_negative_to_zero and value < 0.0:
+			value = 0.0
+
+		out[i] = value
@@ -5,10 +5,19 @@ import numpy as np
 import pandas as pd
 import logging
 import os
+import math
+import functools
+import tempfile
+import resampy
+import tensorflow as tf
+from numba import njit, prange
 from tensorflow.keras import models
 
-from functions.helper_functions import calculate_vector_magnitude
 from functions.signal_processing_functions import resample_acceleration
+from functions.gt3x_functions import rescale_log_data
+
+# module level logger, messages are formatted lazily so suppressed levels do not pay for string formatting
+logger = logging.getLogger(__name__)
 
 def find_candidate_non_wear_segments_from_raw(acc_data, std_threshold, hz, min_segment_length = 1, sliding_window = 1, use_vmu = False):
 	"""
@@ -35,55 +44,36 @@ def find_candidate_non_wear_segments_from_raw(acc_data, std_threshold, hz, min_s
 	# adjust the minimum segment lenght to reflect minutes
 	min_segment_length*= hz * 60
 
+	# use float32 acceleration data, this halves the memory that is read by the standard deviation calculations (the sums are still accumulated with double precision). The data is also made contiguous
+	# in memory if it is not, data that already is float32 and contiguous is not copied. Integer data (e.g. the raw values of a .gt3x file) is used as is
+	acc_data = _as_contiguous(acc_data)
+
 	# define new non wear time vector that we initiale to all 1s, so we only have the change when we have non wear time as it is encoded as 0
-	non_wear_vector = np.ones((len(acc_data), 1), dtype = np.uint8)
 	non_wear_vector_final = np.ones((len(acc_data), 1), dtype = np.uint8)
 
-	# loop over slices of the data
-	for i in range(0,len(acc_data), sliding_window):
-
-		# slice the data
-		data = acc_data[i:i + sliding_window]
-
-		# calculate VMU if set to true
-		if use_vmu:
-			# calculate the VMU of XYZ
-			data = calculate_vector_magnitude(data)
-	
-		# calculate the standard deviation of each column (YXZ)
-		std = np.std(data, axis=0)
-
-		# check if all of the standard deviations are below the standard deviation threshold
-		if np.all(std <= std_threshold):
-
-			# add the non-wear time encoding to the non-wear-vector for the correct time slices
-			non_wear_vector[i:i+sliding_window] = 0
+	# check for each slice of the data if all of the standard deviations are below the standard deviation threshold (or the standard deviation of the VMU if set to True, 
+	# the VMU is calculated on the fly so no array with the VMU of the whole signal is created)
+	low_std_slices = _find_low_std_slices(acc_data, sliding_window, std_threshold, use_vmu)
 
-	# find all indexes of the numpy array that have been labeled non-wear time
-	non_wear_indexes = np.where(non_wear_vector == 0)[0]
+	# find the first and last sample of each consecutive range of low standard deviation slices directly from the slice labels, so no vector with a label for each sample is needed
+	# (the last slice can be shorter than the sliding window)
+	changes = np.diff(np.concatenate(([False], low_std_slices, [False])).astype(np.int8))
+	start_slices = np.flatnonzero(changes == 1) * sliding_window
+	end_slices = np.minimum(np.flatnonzero(changes == -1) * sliding_window, len(acc_data)) - 1
 
-	# find the min and max of those ranges, and increase incrementally to find the edges of the non-wear time
-	for row in find_consecutive_index_ranges(non_wear_indexes):
+	# increase the ranges incrementally to find the edges of the non-wear time, the ranges are independent so they are searched in parallel
+	start_slices, end_slices = _search_low_std_ranges(acc_data, start_slices, end_slices, std_threshold, hz * 60)
 
-		# check if not empty
-		if row.size != 0:
+	for start_slice, end_slice in zip(start_slices, end_slices):
 
-			# define the start and end of the index range
-			start_slice, end_slice = np.min(row), np.max(row)
+		# calculate the length of the slice (or segment)
+		length_slice = end_slice - start_slice
 
-			# backwards search to find the edge of non-wear time vector
-			start_slice = backward_search_non_wear_time(data = acc_data, start_slice = start_slice, end_slice = end_slice, std_max = std_threshold, hz = hz) 
-			# forward search to find the edge of non-wear time vector
-			end_slice = forward_search_non_wear_time(data = acc_data, start_slice = start_slice, end_slice = end_slice, std_max = std_threshold, hz = hz)
+		# minimum length of the non-wear time
+		if length_slice >= min_segment_length:
 
-			# calculate the length of the slice (or segment)
-			length_slice = end_slice - start_slice
-
-			# minimum length of the non-wear time
-			if length_slice >= min_segment_length:
-
-				# update numpy array by setting the start and end of the slice to zero (this is a non-wear candidate)
-				non_wear_vector_final[start_slice:end_slice] = 0
+			# update numpy array by setting the start and end of the slice to zero (this is a non-wear candidate)
+			non_wear_vector_final[start_slice:end_slice] = 0
 
 	# return non wear vector with 0= non-wear and 1 = wear
 	return non_wear_vector_final
@@ -109,6 +99,36 @@ def find_consecutive_index_ranges(vector, increment = 1):
 	return np.split(vector, np.where(np.diff(vector) != increment)[0]+1)
 
 
+def find_consecutive_index_range_bounds(vector, increment = 1):
+	"""
+	Find the first and last value of each range of consequetive indexes in numpy array. This gives the same ranges as find_consecutive_index_ranges, but without
+	creating an array for each range
+
+	Parameters
+	---------
+	data: numpy vector
+		numpy vector of integer values
+	increment: int (optional)
+		difference between two values (typically 1)
+
+	Returns
+	-------
+	starts : np.array
+		first value of each range, for instance [1, 8, 44]
+	stops : np.array
+		last value of each range, for instance [4, 10, 44]
+	"""
+
+	# no ranges if the vector is empty
+	if vector.size == 0:
+		return vector[:0], vector[:0]
+
+	# position of the last value of each range, except the last range that ends at the end of the vector
+	breaks = np.flatnonzero(np.diff(vector) != increment)
+
+	return vector[np.concatenate(([0], breaks + 1))], vector[np.concatenate((breaks, [vector.size - 1]))]
+
+
 def forward_search_non_wear_time(data, start_slice, end_slice, std_max, hz, time_step = 60):
 	"""
 	Increase the end_slice to obtain more non_wear_time (used when non-wear range has been found but due to window size, the actual non-wear time can be slightly larger)
@@ -130,24 +150,8 @@ def forward_search_non_wear_time(data, start_slice, end_slice, std_max, hz, time
 	# adjust time step on number of samples per time step window
 	time_step *= hz
 
-	# define the end of the range
-	end_of_data = len(data)
-
-	# Do-while loop
-	while True:
-
-		# define temporary end_slice variable with increase by step
-		temp_end_slice = end_slice + time_step
-
-		# check condition range still contains non-wear time
-		if temp_end_slice <= end_of_data and np.all(np.std(data[start_slice:temp_end_slice], axis=0) <= std_max):
-			
-			# update the end_slice with the temp end slice value
-			end_slice = temp_end_slice
-
-		else:
-			# here we have found that the additional time we added is not non-wear time anymore, stop and break from the loop by returning the updated slice
-			return end_slice
+	# extend the end of the range step by step with a compiled kernel that keeps running sums of the range
+	return _forward_search_low_std(data, start_slice, end_slice, std_max, time_step)
 
 
 def backward_search_non_wear_time(data, start_slice, end_slice, std_max, hz, time_step = 60):
@@ -171,23 +175,8 @@ def backward_search_non_wear_time(data, start_slice, end_slice, std_max, hz, tim
 	# adjust time step on number of samples per time step window
 	time_step *= hz
 
-	# Do-while loop
-	while True:
-
-		# define temporary end_slice variable with increase by step
-		temp_start_slice = start_slice - time_step
-
-		# logging.debug('Decreasing temp_start_slice to: {}'.format(temp_start_slice))
-
-		# check condition range still contains non-wear time
-		if temp_start_slice >= 0 and np.all(np.std(data[temp_start_slice:end_slice], axis=0) <= std_max):
-			
-			# update the start slice with the new temp value
-			start_slice = temp_start_slice
-
-		else:
-			# here we have found that the additional time we added is not non-wear time anymore, stop and break from the loop by returning the updated slice
-			return start_slice
+	# extend the start of the range step by step with a compiled kernel that keeps running sums of the range
+	return _backward_search_low_std(data, start_slice, end_slice, std_max, time_step)
 
 
 def group_episodes(episodes, distance_in_min = 3, correction = 3, hz = 100, training = False):
@@ -208,96 +197,44 @@ def group_episodes(episodes, distance_in_min = 3, correction = 3, hz = 100, trai
 	Returns
 	--------
 	grouped_episodes : pd.DataFrame()
-		dataframe with grouped episodes
+		dataframe with grouped episodes (one row per group)
 	"""
 
 	# check if there is only 1 episode in the episodes dataframe, if so, we need not to do anything since we cannot merge episodes if we only have 1
 	if episodes.empty or len(episodes) == 1:
-		# transpose back and return
-		return episodes.T
-
-	# create a new dataframe that will contain the grouped rows
-	grouped_episodes = pd.DataFrame()
-
-	# get all current values from the first row
-	current_start = episodes.iloc[0]['start']
-	current_start_index = episodes.iloc[0]['start_index']
-	current_stop = episodes.iloc[0]['stop']
-	current_stop_index = episodes.iloc[0]['stop_index']
-	current_label = None if not training else episodes.iloc[0]['label']
-	current_counter = episodes.iloc[0]['counter']
-
-
-	# loop over each next row (note that we skip the first row)
-	for _, row in episodes.iloc[1:].iterrows():
-
-		# define all next values
-		next_start = row.loc['start']
-		next_start_index = row.loc['start_index']
-		next_stop = row.loc['stop']
-		next_stop_index = row.loc['stop_index']
-		next_label = None if not training else row.loc['label']
-		next_counter = row.loc['counter']
-
-		# check if there are 'distance_in_min' minutes apart from current and next ( + correction for some adjustment)
-		if next_start_index - current_stop_index <= hz * 60 * distance_in_min + correction:
-			
-			# here the two episodes are close to eachother, we update the values and continue the next row to see if we can group more. If it's the last row, we need to add it to the dataframe
-			current_stop_index = next_stop_index
-			current_stop = next_stop
-
-			# check if row is the last row
-			if next_counter == episodes.iloc[-1]['counter']:
-
-				# create the counter label
-				counter_label = f'{current_counter}-{next_counter}'
-
-				# save to new dataframe
-				grouped_episodes[counter_label] = pd.Series({ 	'counter' : counter_label,
-																'start_index' : current_start_index,
-																'start' : current_start,
-																'stop_index' : current_stop_index,
-																'stop' : current_stop,
-																'label' : None if not training else current_label })
-		else:			
-			
-			# create the counter label
-			counter_label = current_counter if (next_counter - current_counter == 1) else f'{current_counter}-{next_counter - 1}'
-
-			# save to new dataframe
-			grouped_episodes[counter_label] = pd.Series({ 	'counter' : counter_label,
-															'start_index' : current_start_index,
-															'start' : current_start,
-															'stop_index' : current_stop_index,
-															'stop' : current_stop,
-															'label' : None if not training else current_label})
-
-			# update tracker variables
-			current_start = next_start
-			current_start_index = next_start_index
-			current_stop = next_stop
-			current_stop_index = next_stop_index
-			current_label = next_label
-			current_counter = next_counter
-
-			# check if last row then also include by itself
-			if next_counter == episodes.iloc[-1]['counter']:
-
-				# save to new dataframe
-				grouped_episodes[next_counter] = pd.Series({ 	'counter' : next_counter,
-																'start_index' : current_start_index,
-																'start' : current_start,
-																'stop_index' : current_stop_index,
-																'stop' : current_stop,
-																'label' : None if not training else current_label })
-
-	return grouped_episodes
+		return episodes
+
+	# get the start and stop indexes of all episodes
+	start_indexes = episodes['start_index'].to_numpy()
+	stop_indexes = episodes['stop_index'].to_numpy()
+	counters = episodes['counter'].to_numpy()
+
+	# position of the first episode and the stop index of each group, an episode is merged with the previous episodes if it is not more than 'distance_in_min' minutes ( + correction for some adjustment) apart
+	first, grouped_stop_indexes = _merge_episodes(start_indexes, stop_indexes, max_distance = hz * 60 * distance_in_min + correction)
+
+	# position of the last episode of each group
+	last = np.concatenate((first[1:] - 1, [len(episodes) - 1]))
+
+	# gather the counters of the first and last episode of each group once, so the loop below does not index the counters array for every group
+	first_counters = counters[first].tolist()
+	last_counters = counters[last].tolist()
+
+	# create the counter label, the counter of a single episode, or the counters of the first and last episode of a group of episodes
+	counter_labels = [first_counter if f == l else f'{first_counter}-{last_counter}' for f, l, first_counter, last_counter in zip(first.tolist(), last.tolist(), first_counters, last_counters)]
+
+	# create the grouped episodes in one go, the start is taken from the first episode and the stop from the last episode of each group
+	return pd.DataFrame({	'counter' : counter_labels,
+										'start_index' : start_indexes[first],
+										'start' : episodes['start'].to_numpy()[first],
+										'stop_index' : grouped_stop_indexes,
+										'stop' : episodes['stop'].to_numpy()[last],
+										'label' : None if not training else episodes['label'].to_numpy()[first]}, index = counter_labels)
 
 
 
 def cnn_nw_algorithm(raw_acc, hz, cnn_model_file, std_threshold = 0.004, distance_in_min = 5, episode_window_sec = 7, edge_true_or_false = True,\
 								start_stop_label_decision = 'and', nwt_encoding = 1, wt_encoding = 0,
-								min_segment_length = 1, sliding_window = 1, verbose = False):
+								min_segment_length = 1, sliding_window = 1, use_tflite = False, quantized = False, resample_cnn_only = False, batch_size = None, acceleration_scale = None, verbose = False):
 	"""
 	Infer non-wear time from raw 100Hz triaxial data. Data at different sample frequencies will be resampled to 100hz.
 
@@ -339,8 +276,9 @@ def cnn_nw_algorithm(raw_acc, hz, cnn_model_file, std_threshold = 0.004, distanc
 		numpy array that contains raw triaxial data at 100hz. Size of the array should be (n_samples, 3)
 	hz : int
 		sample frequency of the data. The CNN model was trained for 100Hz of data. If the data is at a different sampling frequency it will be resampled to 100Hz
-	cnn_model_file : os.path
-		file location of the trained CNN model
+	cnn_model_file : os.path or tf.keras.Model
+		file location of the trained CNN model, or an already loaded Keras model. Models loaded from a file are cached, so processing multiple files with the same model
+		only loads the model once (see also load_cnn_model). A loaded Keras model can not be combined with 'use_tflite' or 'quantized'
 	std_threshold : float (optional)
 		standard deviation threshold to find candidate non-wear episodes. Default 0.004 g  
 	distance_in_min : int (optional)
@@ -367,6 +305,24 @@ def cnn_nw_algorithm(raw_acc, hz, cnn_model_file, std_threshold = 0.004, distanc
 		minimum length of the segment to be candidate for non-wear time
 	sliding_window : int (optional)
 		sliding window in minutes that will go over the acceleration data to find candidate non-wear segments
+	use_tflite : Bool (optional)
+		set to True to infer the labels with a TensorFlow Lite version of the CNN model, which has less overhead than Keras when running on the CPU. The TensorFlow Lite model
+		is created next to 'cnn_model_file' (with a .tflite extension) the first time it is used. Default False.
+	quantized : Bool (optional)
+		set to True to infer the labels with an int8 quantized TensorFlow Lite version of the CNN model (implies 'use_tflite'). The quantized model is created next to 'cnn_model_file'
+		(with a _int8.tflite extension) the first time it is used, and calibrated with features sampled from 'raw_acc'. Default False.
+	resample_cnn_only : Bool (optional)
+		set to True to process data that is not at 100hz at its own sampling frequency, and only resample the start and stop features to 100hz before they are classified 
+		with the CNN model. This avoids resampling the full acceleration data, and the non-wear vector and indexes are then at the sampling frequency of 'raw_acc'. Default False.
+	batch_size : int (optional)
+		maximum number of features that are classified with the CNN model at once, this limits the memory that is needed for the features of data with many candidate non-wear
+		episodes. Default None, which classifies all features at once.
+	acceleration_scale : float (optional)
+		acceleration scale of the device (e.g. 256 LSB/g) if 'raw_acc' contains the raw integer values as stored in the .gt3x file instead of g values. The candidate non-wear episodes and
+		their edges are then found on the raw values (with the standard deviation threshold scaled accordingly), and only the start and stop features are converted to g values before
+		they are classified, so no float copy of the full acceleration data is created. For a power of two scale (such as 256) the results are exactly the same as for data that
+		is converted to g values first. For other scales (such as 341) the scaled threshold is rounded differently, so a standard deviation that is (almost) exactly equal to the
+		threshold can be classified differently. Default None, which means that 'raw_acc' is in g values.
 	verbose : Bool (optional)
 		set to True if debug messages should be printed to the console and log file. Default False.
 
@@ -385,28 +341,50 @@ def cnn_nw_algorithm(raw_acc, hz, cnn_model_file, std_threshold = 0.004, distanc
 
 	# check if data is triaxial
 	if raw_acc.shape[1] != 3:
-		logging.error(f'Acceleration data should be triaxial/3 axes. Number of axes found is {raw_acc.shape[1]}')
+		logger.error('Acceleration data should be triaxial/3 axes. Number of axes found is %s', raw_acc.shape[1])
 		exit(1)
 
 	# check if wear time encoding and non-wear time encoding are different
 	if wt_encoding == nwt_encoding:
-		logging.error('Wear time encoding and non-wear time encoding are the same, whereas they should be different.')
+		logger.error('Wear time encoding and non-wear time encoding are the same, whereas they should be different.')
+		exit(1)
+
+	# check if the start/stop decision is known
+	if start_stop_label_decision not in ['or', 'and']:
+		logger.error('Start/Stop decision unknown, can only use or/and, given: %s', start_stop_label_decision)
 		exit(1)
 
-	# check if data needs to be resampled to 100hz
-	if hz != 100:
-		logging.info(f'Sampling frequency of the data is {hz}Hz, should be 100Hz, starting resampling....')
+	# check if the batch size is a positive number of features
+	if batch_size is not None and batch_size < 1:
+		logger.error('Batch size should be at least 1, given: %s', batch_size)
+		exit(1)
+
+	# raw integer data is converted to g values if the full data needs to be resampled
+	if acceleration_scale is not None and hz != 100 and not resample_cnn_only:
+		raw_acc = rescale_log_data(log_data = raw_acc, acceleration_scale = acceleration_scale)
+		acceleration_scale = None
+
+	# check if data needs to be resampled to 100hz (if only the CNN features are resampled, the data is processed at its own sampling frequency)
+	if hz != 100 and not resample_cnn_only:
+		logger.info('Sampling frequency of the data is %sHz, should be 100Hz, starting resampling....', hz)
 		# call resampling function
 		raw_acc = resample_acceleration(data = raw_acc, from_hz = hz, to_hz = 100, verbose = verbose)
-		logging.info('Data resampled to 100hz')
+		logger.info('Data resampled to 100hz')
 		# set sampling frequency to 100hz
 		hz = 100
 
+	if acceleration_scale is None:
+		# use contiguous float32 acceleration data, which is also the input type of the CNN model. Data that already is float32 and contiguous is not copied
+		raw_acc = _as_contiguous_float32(raw_acc)
+	else:
+		# use the raw integer data as is. The standard deviation scales linearly with the data, so the threshold in g is converted to a threshold in raw values (for a power of two scale, such as 256, 
+		# the candidate non-wear episodes and their edges are exactly the same as when the data is converted to g values first, for other scales they can differ at the threshold itself)
+		raw_acc = _as_contiguous(raw_acc)
+		std_threshold *= float(acceleration_scale)
+
 	
 	# create new non-wear vector that is prepopulated with wear-time encoding. This way we only have to record the non-wear time
 	nw_vector = np.full(shape = [raw_acc.shape[0], 1], fill_value = wt_encoding, dtype = 'uint8')
-	# empty list to keep track of non-wear time start and stop indexes.
-	nw_start_stop_indexes = []
 
 	"""
 		FIND CANDIDATE NON-WEAR SEGMENTS ACTIGRAPH ACCELERATION DATA
@@ -421,139 +399,216 @@ def cnn_nw_algorithm(raw_acc, hz, cnn_model_file, std_threshold = 0.004, distanc
 		GET START AND END TIME OF NON WEAR SEGMENTS
 	"""
 
-	# find all indexes of the numpy array that have been labeled non-wear time
-	nw_indexes = np.where(nw_episodes == 0)[0]
-	# find consecutive ranges
-	non_wear_segments = find_consecutive_index_ranges(nw_indexes)
-	# empty dictionary where we can store the start and stop times
-	dic_segments = {}
-
-	# check if segments are found
-	if len(non_wear_segments[0]) > 0:
-		
-		# find start and stop times (the indexes of the edges and find corresponding time)
-		for i, row in enumerate(non_wear_segments):
-
-			# find start and stop
-			start, stop = np.min(row), np.max(row)
-
-			# add the start and stop times to the dictionary
-			# note that start and stop timestamps are not given. 
-			dic_segments[i] = {'counter' : i, 'start' : start, 'start_index': start, 'stop' : stop, 'stop_index' : stop}
-	
-	# create dataframe from segments
-	episodes = pd.DataFrame.from_dict(dic_segments)
-	
+	# find the first and last index of each consecutive range of non-wear time (encoded as 0), directly from the changes in the candidate non-wear vector
+	changes = np.diff(np.concatenate(([1], nw_episodes[:,0], [1])).astype(np.int8))
+	starts = np.flatnonzero(changes == -1)
+	stops = np.flatnonzero(changes == 1) - 1
+
 	"""
 		MERGE EPISODES THAT ARE CLOSE TO EACH OTHER
-	"""				
-	grouped_episodes = group_episodes(episodes = episodes.T, distance_in_min = distance_in_min, correction = 3, hz = hz, training = False).T
+	"""
+
+	# merge episodes that are not more than 'distance_in_min' minutes (+ a correction of 3 samples) apart, directly on the start and stop arrays (the same as group_episodes, but without creating dataframes)
+	first, grouped_stop_indexes = _merge_episodes(starts, stops, max_distance = hz * 60 * distance_in_min + 3)
+	grouped_start_indexes = starts[first]
 	
 	"""
 		LOAD CNN MODEL
 	"""	
 
-	# load CNN model
-	cnn_model = models.load_model(cnn_model_file)
+	# number of samples in a feature window
+	episode_window = episode_window_sec * hz
+
+	# create a zero-copy view of all windows of 'episode_window' samples in the data with shape num windows x time x axes, features are gathered from this view without slicing the data
+	# window by window (if the data is shorter than a single window, the window is the full data)
+	windows = np.lib.stride_tricks.sliding_window_view(raw_acc, window_shape = (min(episode_window, raw_acc.shape[0]), raw_acc.shape[1]))[:, 0]
+
+	# check if an already loaded Keras model is given instead of a file location
+	if not isinstance(cnn_model_file, (str, os.PathLike)):
+		if use_tflite or quantized:
+			logger.error('A loaded Keras model can not be used with use_tflite or quantized, give the file location of the CNN model instead.')
+			exit(1)
+		# use the loaded model as is
+		cnn_model = cnn_model_file
+	elif quantized:
+		# sample evenly spaced features from the data, these are used to calibrate the int8 quantization when the quantized model is created
+		representative_features = windows[np.linspace(0, len(windows) - 1, num = 100, dtype = np.int64)]
+		# convert raw integer features to g values
+		if acceleration_scale is not None:
+			representative_features = rescale_log_data(log_data = representative_features, acceleration_scale = acceleration_scale)
+		# the CNN model was trained with 100hz data
+		if hz != 100:
+			representative_features = resampy.resample(representative_features, hz, 100, axis = 1).astype(np.float32)
+		# get the int8 quantized TensorFlow Lite version of the CNN model (this converts the model the first time it is used)
+		cnn_model = _get_tflite_model(cnn_model_file, representative_features = representative_features)
+	elif use_tflite:
+		# get the TensorFlow Lite version of the CNN model (this converts the model the first time it is used)
+		cnn_model = _get_tflite_model(cnn_model_file)
+	else:
+		# load CNN model (only the first time this file is used)
+		cnn_model = _load_cnn_model(cnn_model_file)
 
 	"""
-		FOR EACH EPISODE, EXTEND THE EDGES, CREATE FEATURES, AND INFER LABEL
+		FOR EACH EPISODE, EXTEND THE EDGES
 	"""
-	for _, row in grouped_episodes.iterrows():
 
-		start_index = int(row.loc['start_index'])
-		stop_index = int(row.loc['stop_index'])
+	# backward search to extend the start indexes and forward search to extend the stop indexes of all episodes (in parallel), with steps of 1 second for at most 5 minutes
+	start_indexes, stop_indexes = _search_low_std_episodes(raw_acc, grouped_start_indexes, grouped_stop_indexes, hz, hz * 60 * 5, std_threshold)
 
-		if verbose:
-			logging.debug(f'Processing episode start_index : {start_index}, stop_index : {stop_index}')
-	
-		# forward search to extend stop index
-		stop_index = _forward_search_episode(raw_acc, stop_index, hz = hz, max_search_min = 5, std_threshold = std_threshold, verbose = verbose)
-		# backwar search to extend start index
-		start_index = _backward_search_episode(raw_acc, start_index, hz = hz, max_search_min = 5, std_threshold = std_threshold, verbose = verbose)
-
-		# get start episode
-		start_episode = raw_acc[start_index - (episode_window_sec * hz) : start_index]
-		# get stop episode
-		stop_episode = raw_acc[stop_index : stop_index + (episode_window_sec * hz)]
-
-		# default label for start and stop combined. The first False will turn into True if the start of the episode is inferred as non-wear time. The same happens to the
-		# second False when the end is inferred as non-weaer time
-		start_stop_label = [False, False]
-
-		"""
-			START EPISODE
-		""" 
-		if start_episode.shape[0] == episode_window_sec * hz:
-
-			# reshape into num feature x time x axes
-			start_episode = start_episode.reshape(1, start_episode.shape[0], start_episode.shape[1]) 
-			
-			# get binary class from model
-			start_label = cnn_model.predict_classes(start_episode).squeeze()
-
-			# if the start label is 1, this means that it is wear time, and we set the first start_stop_label to 1
-			if start_label == 1:
-				start_stop_label[0] = True	
-		
-		else:
-			# there is an episode right at the start of the data, since we cannot obtain a full epsisode_window_sec array
-			# here we say that True for nw-time and False for wear time
-			start_stop_label[0] = edge_true_or_false
-		
-
-		"""
-			STOP EPISODE
-		""" 
-		if stop_episode.shape[0] == episode_window_sec * hz:
-			
-			# reshape into num feature x time x axes
-			stop_episode = stop_episode.reshape(1, stop_episode.shape[0], stop_episode.shape[1]) 
-			
-			# get binary class from model
-			stop_label = cnn_model.predict_classes(stop_episode).squeeze()
-
-			# if the start label is 1, this means that it is wear time, and we set the first start_stop_label to 1
-			if stop_label == 1:
-				start_stop_label[1] = True	
-		else:
-			# there is an episode right at the END of the data, since we cannot obtain a full epsisode_window_sec array
-			# here we say that True for nw-time and False for wear time
-			start_stop_label[1] = edge_true_or_false
-		
-		# check the start_stop_label.
-		if start_stop_label_decision == 'or':
-			# use logical OR to determine if episode is true non-wear time
-			if any(start_stop_label):
-				# true non-wear time, record start and stop in nw-vector
-				nw_vector[start_index:stop_index] = nwt_encoding
-				# add start and stop to nw_data (this is the human readable start and stop)
-				nw_start_stop_indexes.append([start_index, stop_index])
-				# verbose
-				if verbose:
-					logging.info(f'Found non-wear time: start_index : {start_index}, Stop_index: {stop_index}')
-
-		elif start_stop_label_decision == 'and':
-
-			# use logical and to determine if episode is true non-wear time
-			if all(start_stop_label):
-				# true non-wear time, record start and stop in nw-vector
-				nw_vector[start_index:stop_index] = nwt_encoding
-				# add start and stop to nw_data
-				nw_start_stop_indexes.append([start_index, stop_index])
-				# verbose
-				if verbose:
-					logging.info(f'Found non-wear time: start_index : {start_index}, Stop_index: {stop_index}')
+	if verbose:
+		for old_start_index, old_stop_index, start_index, stop_index in zip(grouped_start_indexes, grouped_stop_indexes, start_indexes, stop_indexes):
+			logger.debug('Extended episode start_index : %s -> %s, stop_index : %s -> %s', old_start_index, start_index, old_stop_index, stop_index)
+
+	"""
+		CREATE FEATURES AND INFER LABELS OF ALL EPISODES AT ONCE
+	"""
+
+	# a start feature (t-'episode_window_sec' to t) can only be created if there is enough data before the start of the episode. The same holds for the stop feature after the end of the episode
+	has_start_episode = start_indexes >= episode_window
+	has_stop_episode = stop_indexes + episode_window <= raw_acc.shape[0]
+
+	# start index of the start and stop features of all episodes. The start feature ends at the start of the episode, the stop feature starts at the end of the episode
+	feature_indexes = np.concatenate([start_indexes[has_start_episode] - episode_window, stop_indexes[has_stop_episode]])
+
+	# get binary class of all features from the model in a single call (or a call per 'batch_size' features), this avoids the model overhead of a call per feature
+	labels = np.empty(len(feature_indexes), dtype = 'int32')
 
+	# number of features that are classified at once
+	batch_size = max(len(feature_indexes), 1) if batch_size is None else batch_size
+
+	for batch_start in range(0, len(feature_indexes), batch_size):
+
+		# start indexes of the features in this batch
+		batch_indexes = feature_indexes[batch_start:batch_start + batch_size]
+
+		# gather the features from the view into a single new batch (features x time x axes). Data in g values is already float32, which is the input type of the model, so this is the only copy
+		features = windows[batch_indexes]
+
+		# raw integer features are converted to g values (float32), only the features are converted and not the full acceleration data
+		if acceleration_scale is not None:
+			features = rescale_log_data(log_data = features, acceleration_scale = acceleration_scale)
+
+		# if the data is not at 100hz, only the features are resampled to the 100hz the CNN model was trained with
+		if hz != 100:
+			features = resampy.resample(features, hz, 100, axis = 1).astype(np.float32)
+
+		if use_tflite or quantized:
+			labels[batch_start:batch_start + len(batch_indexes)] = _predict_classes_tflite(cnn_model, features).squeeze(axis = -1)
 		else:
-			logging.error(f'Start/Stop decision unknown, can only use or/and, given: {start_stop_label_decision}')
-			exit(1)
+			# classify the features in a single call of the (cached) graph function of the model
+			labels[batch_start:batch_start + len(batch_indexes)] = _get_cnn_classifier(cnn_model)(features).numpy().squeeze(axis = -1)
+
+	# if the label is 1, this means that it is non-wear time, and we set the start or stop label to True. The first labels belong to the start features, the remaining labels to the stop features.
+	# if there is an episode right at the start or end of the data, we cannot obtain a full epsisode_window_sec array, here we use the default edge_true_or_false (True for nw-time and False for wear time)
+	start_labels = np.full(len(start_indexes), fill_value = edge_true_or_false, dtype = bool)
+	start_labels[has_start_episode] = labels[:has_start_episode.sum()] == 1
+	stop_labels = np.full(len(stop_indexes), fill_value = edge_true_or_false, dtype = bool)
+	stop_labels[has_stop_episode] = labels[has_start_episode.sum():] == 1
+
+	"""
+		FOR EACH EPISODE, DETERMINE IF IT IS NON-WEAR TIME
+	"""
+
+	# use logical OR (one side) or logical AND (both sides) of the start and stop labels of all episodes to determine if an episode is true non-wear time
+	if start_stop_label_decision == 'or':
+		is_non_wear = start_labels | stop_labels
+	else:
+		is_non_wear = start_labels & stop_labels
+
+	# start and stop indexes of the true non-wear time episodes (this is the human readable start and stop)
+	nw_start_stop_indexes = np.column_stack((start_indexes[is_non_wear], stop_indexes[is_non_wear])).tolist()
+
+	for start_index, stop_index in nw_start_stop_indexes:
+
+		# true non-wear time, record start and stop in nw-vector
+		nw_vector[start_index:stop_index] = nwt_encoding
+
+		# verbose
+		if verbose:
+			logger.info('Found non-wear time: start_index : %s, Stop_index: %s', start_index, stop_index)
 
 	return nw_vector, nw_start_stop_indexes
 
 
+def load_cnn_model(cnn_model_file):
+	"""
+	Load a trained CNN model so it can be passed to cnn_nw_algorithm when many files are processed. The model is loaded once, and the function that classifies the features
+	is traced once with a dummy feature, so the first file that is processed does not pay for building the TensorFlow graph
+
+	Parameters
+	----------
+	cnn_model_file : os.path
+		file location of the trained CNN model
+
+	Returns
+	--------
+	cnn_model : tf.keras.Model
+		loaded Keras model
+	"""
+
+	# load CNN model (only the first time this file is used)
+	cnn_model = _load_cnn_model(cnn_model_file)
+
+	# warm up the (cached) graph function of the model by classifying a single feature of zeros
+	_get_cnn_classifier(cnn_model)(np.zeros((1,) + tuple(cnn_model.input_shape[1:]), dtype = np.float32))
+
+	return cnn_model
+
+
+def hees_2013_calculate_block_features(data, hz = 100, block_size = 15):
+	"""
+	Calculate the features of consecutive blocks of the acceleration data that are needed to calculate the standard deviation and value range of the windows in the Hees 2013 non-wear algorithm.
+	Windows that are a multiple of the block size are combined from the block features, so the features can be calculated once and shared between calls of 
+	hees_2013_calculate_non_wear_time with different window lengths (for example 30, 60, and 135 minutes windows with a window overlap of 15 minutes can all use 15 minute blocks)
+
+	Parameters
+	----------
+	data: np.array(n_samples, axes)
+		numpy array with acceleration data in g values. Each column represent a different axis, normally ordered YXZ. If the array is stored in Fortran order (each axis contiguous in memory, 
+		for example np.asfortranarray(data)), the features are calculated per axis on the contiguous memory
+	hz: int (optional)
+		sample frequency in hertz. Indicates the number of samples per 1 second. Default to 100 for 100hz.
+	block_size : int or float (optional)
+		length of a block in minutes. Defaults to 15 minutes.
+
+	Returns
+	---------
+	block_features : dictionary
+		dictionary with the block size in samples and, for each full block and each axis, the sum, sum of squares, minimum, and maximum acceleration
+	"""
+
+	# define the correct number of samples for the block size
+	block_size = int(round(block_size * hz * 60))
+
+	# number of full blocks in the data, a partial block at the end of the data is not part of a full window
+	num_blocks = len(data) // block_size
+
+	# check if each axis is stored contiguously (structure of arrays), if so, reduce each axis over its own contiguous memory instead of striding over all axes
+	if data.ndim == 2 and data.shape[1] > 1 and data.flags.f_contiguous:
+
+		# reshape the transposed data (a view, no copy) into axes x blocks x samples
+		blocks = data.T[:, :num_blocks * block_size].reshape(data.shape[1], num_blocks, block_size)
+
+		# calculate features of each axis (YXZ) and each block, and transpose them to blocks x axes. Sums are calculated with float64 accumulators
+		return {'block_size' : block_size,
+				'sum' : blocks.sum(axis = 2, dtype = np.float64).T,
+				'sum_squares' : np.einsum('ijk,ijk->ji', blocks, blocks, dtype = np.float64),
+				'min' : blocks.min(axis = 2).T,
+				'max' : blocks.max(axis = 2).T}
+
+	# reshape the data into blocks x samples x axes
+	blocks = data[:num_blocks * block_size].reshape(num_blocks, block_size, data.shape[1])
+
+	# calculate features of each block and each column (YXZ). Sums are calculated with float64 accumulators
+	return {'block_size' : block_size,
+			'sum' : blocks.sum(axis = 1, dtype = np.float64),
+			'sum_squares' : np.einsum('ijk,ijk->ik', blocks, blocks, dtype = np.float64),
+			'min' : blocks.min(axis = 1),
+			'max' : blocks.max(axis = 1)}
+
+
 def hees_2013_calculate_non_wear_time(data, hz = 100, min_non_wear_time_window = 60, window_overlap = 15, std_mg_threshold = 3.0, std_min_num_axes = 2,\
-										value_range_mg_threshold = 50.0, value_range_min_num_axes = 2, nwt_encoding = 0, wt_encoding = 1):
+										value_range_mg_threshold = 50.0, value_range_min_num_axes = 2, nwt_encoding = 0, wt_encoding = 1, block_features = None):
 	"""
 	Estimation of non-wear time periods based on Hees 2013 paper
 
@@ -593,6 +648,9 @@ def hees_2013_calculate_non_wear_time(data, hz = 100, min_non_wear_time_window =
 		non-wear time encoding. Defaults to 0
 	wt_encoding : int
 		wear time encoding. Defaults to 1
+	block_features : dictionary (optional)
+		block features as calculated by hees_2013_calculate_block_features. This allows the block features to be shared between calls with different window lengths. The window length and
+		window overlap need to be a multiple of the block size. If not given, the block features are calculated with the largest block size that fits the window length and window overlap.
 
 	Returns
 	---------
@@ -616,40 +674,46 @@ def hees_2013_calculate_non_wear_time(data, hz = 100, min_non_wear_time_window =
 	# deal with non-wear time, since everything else is already set as wear-time.
 	non_wear_vector = np.full(shape = [data.shape[0], 1], fill_value = wt_encoding, dtype = 'uint8')
 
-	# loop over the data, start from the beginning with a step size of window overlap
-	for i in range(0, len(data), window_overlap):
+	# calculate the block features if not given. The largest block size that fits both the window and the window overlap is their greatest common divisor
+	if block_features is None:
+		block_features = hees_2013_calculate_block_features(data, hz = hz, block_size = math.gcd(min_non_wear_time_window, window_overlap) / num_samples_per_min)
 
-		# define the start of the sequence
-		start = i
-		# define the end of the sequence
-		end = i + min_non_wear_time_window
+	# get the block size in samples
+	block_size = block_features['block_size']
 
-		# slice the data from start to end
-		subset_data = data[start:end]
+	# check if the windows can be created from blocks
+	if min_non_wear_time_window % block_size != 0 or window_overlap % block_size != 0:
+		logger.error('Window length (%s) and window overlap (%s) should be a multiple of the block size (%s) in samples', min_non_wear_time_window, window_overlap, block_size)
+		exit(1)
 
-		# check if the data sequence has been exhausted, meaning that there are no full windows left in the data sequence (this happens at the end of the sequence)
-		# comment out if you want to use all the data
-		if len(subset_data) < min_non_wear_time_window:
-			break
+	# number of blocks in a window and number of blocks in the step size of the window overlap
+	window_blocks = min_non_wear_time_window // block_size
+	overlap_blocks = window_overlap // block_size
 
-		# calculate the standard deviation of each column (YXZ)
-		std = np.std(subset_data, axis=0)
+	# check if there is at least one full window in the data, if not, there is nothing to classify as non-wear time
+	if len(block_features['sum']) < window_blocks:
+		return non_wear_vector
 
-		# check if the standard deviation is below the threshold, and if the number of axes the standard deviation is below equals the std_min_num_axes threshold
-		if (std < std_mg_threshold).sum() >= std_min_num_axes:
+	# combine the features of the blocks in each full window, starting from the beginning with a step size of window overlap. Partial windows at the end of the sequence are not included
+	def combine_blocks(block_feature, reduce):
+		# zero-copy view with shape (windows, axes, blocks) that is reduced over the blocks
+		return reduce(np.lib.stride_tricks.sliding_window_view(block_feature, window_shape = window_blocks, axis = 0)[::overlap_blocks], axis = -1)
 
-			# at least 'std_min_num_axes' are below the standard deviation threshold of 'std_min_num_axes', now set this subset of the data to the non-wear time encoding.
-			# Note that the full 'new_wear_vector' is pre-populated with the wear time encoding, so we only have to set the non-wear time.
-			non_wear_vector[start:end] = nwt_encoding
+	# calculate the variance of each column (YXZ) for all windows with var = E[x^2] - E[x]^2. The variance is compared to the squared standard deviation threshold, so no square root is needed
+	mean = combine_blocks(block_features['sum'], np.sum) / min_non_wear_time_window
+	var = combine_blocks(block_features['sum_squares'], np.sum) / min_non_wear_time_window - mean ** 2
 
-		# calculate the value range (difference between the min and max) (here the point-to-point numpy method is used) for each column
-		value_range = np.ptp(subset_data, axis = 0)
+	# calculate the value range (difference between the min and max) for each column of all windows
+	value_range = combine_blocks(block_features['max'], np.max) - combine_blocks(block_features['min'], np.min)
 
-		# check if the value range, for at least 'value_range_min_num_axes' (e.g. 2) out of three axes, was less than 'value_range_mg_threshold' (e.g. 50) mg
-		if (value_range < value_range_mg_threshold).sum() >= value_range_min_num_axes:
+	# check if the standard deviation is below the threshold for at least 'std_min_num_axes' axes, or if the value range, for at least 'value_range_min_num_axes' (e.g. 2) out of three axes,
+	# was less than 'value_range_mg_threshold' (e.g. 50) mg
+	non_wear_windows = ((var < std_mg_threshold ** 2).sum(axis = 1) >= std_min_num_axes) | ((value_range < value_range_mg_threshold).sum(axis = 1) >= value_range_min_num_axes)
 
-			# set the non wear vector to non-wear time for the start to end slice of the data
-			non_wear_vector[start:end] = nwt_encoding
+	# set the non wear vector to non-wear time for each window that was classified as non-wear time
+	# Note that the full 'new_wear_vector' is pre-populated with the wear time encoding, so we only have to set the non-wear time.
+	for start in np.flatnonzero(non_wear_windows) * window_overlap:
+		non_wear_vector[start:start + min_non_wear_time_window] = nwt_encoding
 
 	return non_wear_vector
 
@@ -678,25 +742,16 @@ def raw_baseline_calculate_non_wear_time(raw_acc, std_threshold, min_interval, h
 	# find all indexes of the numpy array that have been labeled non-wear time. Note that the function find_candidate_non_wear_segments_from_raw returns
 	# non-wear episodes as 1, and wear time as 1
 	nw_indexes = np.where(nw_episodes == 0)[0]
-	# find consecutive ranges
-	non_wear_segments = find_consecutive_index_ranges(nw_indexes)
+	# find the start and stop of the consecutive ranges
+	starts, stops = find_consecutive_index_range_bounds(nw_indexes)
 
-	# check if segments are found
-	if len(non_wear_segments[0]) > 0:
-		
-		# find start and stop times (the indexes of the edges and find corresponding time)
-		for _, row in enumerate(non_wear_segments):
+	# calculate lenght of all episodes in minutes
+	lengths = ((stops - starts) / hz / 60).astype(int)
 
-			# find start and stop
-			start, stop = np.min(row), np.max(row)
-
-			# calculate lenght of episode in minutes
-			length = int((stop - start) / hz / 60)
-
-			# check if length exceeds threshold, if so, then this is non-wear time
-			if length >= min_interval:
-				# now update nw vector
-				nw_vector[start:stop] = nwt_encoding
+	# check if length exceeds threshold, if so, then this is non-wear time
+	for start, stop in zip(starts[lengths >= min_interval], stops[lengths >= min_interval]):
+		# now update nw vector
+		nw_vector[start:stop] = nwt_encoding
 
 	# return values
 	return nw_vector
@@ -706,86 +761,675 @@ def raw_baseline_calculate_non_wear_time(raw_acc, std_threshold, min_interval, h
 	INTERNAL HELPER FUNCTIONS
 """
 
-def _forward_search_episode(acc_data, index, hz, max_search_min, std_threshold, verbose = False):
+def _merge_episodes(start_indexes, stop_indexes, max_distance):
 	"""
-	When we have an episode, this was created on a minute resolution, here we do a forward search to find the edges of the episode with a second resolution
+	Merge episodes (sorted by their start index) that are not more than 'max_distance' samples apart, in a single vectorized pass without a python loop over the episodes
+
+	Parameters
+	-----------
+	start_indexes : np.array(episodes)
+		start indexes of the episodes
+	stop_indexes : np.array(episodes)
+		stop indexes of the episodes
+	max_distance : int
+		maximum number of samples between the stop of an episode and the start of the next episode to merge them together
+
+	Returns
+	--------
+	first : np.array(groups)
+		position of the first episode of each group of merged episodes
+	grouped_stop_indexes : np.array(groups)
+		stop index of each group of merged episodes
 	"""
 
-	# calculate max slice index
-	max_slice_index = acc_data.shape[0]
+	# without episodes there is nothing to merge
+	if len(start_indexes) == 0:
+		return np.zeros(0, dtype = np.int64), stop_indexes
 
-	for i in range(hz * 60 * max_search_min):
+	# the running maximum of the stop indexes is the stop of the group so far, this also handles episodes that lie within or overlap with a previous episode
+	running_stop_indexes = np.maximum.accumulate(stop_indexes)
 
-		# create new slices
-		new_start_slice = index
-		new_stop_slice = index + hz
+	# an episode starts a new group if it is more than 'max_distance' apart from the stop of the group so far, otherwise it is merged with the previous episodes
+	first = np.flatnonzero(np.concatenate(([True], start_indexes[1:] - running_stop_indexes[:-1] > max_distance)))
 
-		if verbose:
-			logging.info(f'i : {i}, new_start_slice : {new_start_slice}, new_stop_slice : {new_stop_slice}')
+	# the stop index of a group is the largest stop index of its episodes
+	return first, np.maximum.reduceat(stop_indexes, first)
+
+
+@njit(parallel = True, fastmath = True, cache = True)
+def _find_low_std_slices(data, sliding_window, std_threshold, use_vmu = False):
+	"""
+	Check for consecutive slices of the data if the standard deviation of all columns is below or equal to the standard deviation threshold. Slices are
+	processed in parallel, and the standard deviation is calculated from a running sum and sum of squares (var = E[x^2] - E[x]^2) so each sample is read only once
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+	sliding_window : int
+		number of samples in each slice. The last slice can be shorter if the data is not a multiple of the sliding window
+	std_threshold : int or float
+		the standard deviation threshold in g
+	use_vmu : Boolean (optional)
+		if set to True, the standard deviation of the vector magnitude (sqrt(y^2 + x^2 + z^2)) of each sample is checked instead of the standard deviation of each column
 
-		# check if the new stop slice exceeds the max_slice_index
-		if new_stop_slice > max_slice_index:
-			if verbose:
-				logging.info(f'Max slice index reached : {max_slice_index}')
+	Returns
+	-------
+	low_std_slices : np.array(slices)
+		boolean array with True for each slice that has a standard deviation below or equal to the threshold for all columns
+	"""
+
+	# number of slices, including a partial slice at the end of the data
+	num_slices = (data.shape[0] + sliding_window - 1) // sliding_window
+
+	# empty array to store the result of each slice
+	low_std_slices = np.empty(num_slices, dtype = np.bool_)
+
+	# the variance is compared to the squared threshold, so no square root is needed
+	var_threshold = std_threshold * std_threshold
+
+	# loop over slices of the data in parallel
+	for s in prange(num_slices):
+
+		# define the start and end of the slice
+		start = s * sliding_window
+		end = min(start + sliding_window, data.shape[0])
+		n = end - start
+
+		# keep track if all columns are below the threshold
+		below_threshold = True
+
+		if use_vmu:
+
+			# running sum and sum of squares of the vector magnitude, note that the square of the vector magnitude is the sum of squares of the columns
+			s1 = 0.0
+			s2 = 0.0
+			for i in range(start, end):
+				squared_magnitude = 0.0
+				for j in range(data.shape[1]):
+					squared_magnitude += float(data[i, j]) * data[i, j]
+				s1 += np.sqrt(squared_magnitude)
+				s2 += squared_magnitude
+
+			# calculate the variance of the vector magnitude
+			mean = s1 / n
+			low_std_slices[s] = s2 / n - mean * mean <= var_threshold
+			continue
+
+		for j in range(data.shape[1]):
+
+			# running sum and sum of squares, the values are converted to double precision before they are squared, so the sum of squares is not rounded to float32 before the
+			# mean is subtracted (E[x^2] - E[x]^2 subtracts two nearly equal numbers for the axis that measures gravity)
+			s1 = 0.0
+			s2 = 0.0
+			for i in range(start, end):
+				value = float(data[i, j])
+				s1 += value
+				s2 += value * value
+
+			# calculate the variance of the column, if it exceeds the threshold the remaining columns do not need to be checked
+			mean = s1 / n
+			if s2 / n - mean * mean > var_threshold:
+				below_threshold = False
+				break
+
+		low_std_slices[s] = below_threshold
+
+	return low_std_slices
+
+
+@njit(parallel = True, cache = True)
+def _search_low_std_ranges(data, start_slices, end_slices, std_max, time_step):
+	"""
+	Find the edges of multiple non-wear time ranges by a backward search of the start followed by a forward search of the end of each range (see backward_search_non_wear_time and
+	forward_search_non_wear_time). The ranges are independent, so they are processed in parallel
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+	start_slices : np.array(ranges)
+		start of each known non-wear time range
+	end_slices : np.array(ranges)
+		end of each known non-wear time range
+	std_max : int or float
+		the standard deviation threshold in g
+	time_step : int
+		number of samples to add (or subtract in the backwards search) in each step
+
+	Returns
+	-------
+	new_start_slices : np.array(ranges)
+		updated start of each non-wear time range
+	new_end_slices : np.array(ranges)
+		updated end of each non-wear time range
+	"""
+
+	new_start_slices = np.empty_like(start_slices)
+	new_end_slices = np.empty_like(end_slices)
+
+	for r in prange(start_slices.shape[0]):
+
+		# backwards search to find the start edge, followed by a forward search from the new start to find the end edge
+		new_start_slices[r] = _backward_search_low_std(data, start_slices[r], end_slices[r], std_max, time_step)
+		new_end_slices[r] = _forward_search_low_std(data, new_start_slices[r], end_slices[r], std_max, time_step)
+
+	return new_start_slices, new_end_slices
+
+
+@njit(cache = True, fastmath = True)
+def _forward_search_low_std(data, start_slice, end_slice, std_max, time_step):
+	"""
+	Increase the end_slice in steps of time_step samples as long as the standard deviation of each column of data[start_slice:end_slice] stays below or equal to std_max. 
+	A running sum and sum of squares of the range is kept, so each step only reads the added samples
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+	start_slice : int
+		start of known non-wear time range
+	end_slice : int
+		end of known non-wear time range
+	std_max : int or float
+		the standard deviation threshold in g
+	time_step : int
+		number of samples to add in each step
+
+	Returns
+	-------
+	end_slice : int
+		updated end of the non-wear time range
+	"""
+
+	# running sum and sum of squares of each column of the current range
+	sum_values, sum_squares = _sum_and_sum_squares(data, start_slice, end_slice)
+
+	while end_slice + time_step <= data.shape[0]:
+
+		# sums of the samples that are added in this step
+		add_values, add_squares = _sum_and_sum_squares(data, end_slice, end_slice + time_step)
+
+		# stop when the extended range is not non-wear time anymore
+		if not _is_low_std(sum_values + add_values, sum_squares + add_squares, end_slice + time_step - start_slice, std_max):
 			break
-			
-		# slice out new activity data
-		slice_data = acc_data[new_start_slice:new_stop_slice]
 
-		# calculate the standard deviation of each column (YXZ)
-		std = np.std(slice_data, axis=0)
-		
-		# check if all of the standard deviations are below the standard deviation threshold
-		if np.all(std <= std_threshold):
-			
-			# update index
-			index = new_stop_slice
-		else:
+		# update the end slice and the running sums
+		end_slice += time_step
+		sum_values += add_values
+		sum_squares += add_squares
+
+	return end_slice
+
+
+@njit(cache = True, fastmath = True)
+def _backward_search_low_std(data, start_slice, end_slice, std_max, time_step):
+	"""
+	Decrease the start_slice in steps of time_step samples as long as the standard deviation of each column of data[start_slice:end_slice] stays below or equal to std_max. 
+	A running sum and sum of squares of the range is kept, so each step only reads the added samples
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+	start_slice : int
+		start of known non-wear time range
+	end_slice : int
+		end of known non-wear time range
+	std_max : int or float
+		the standard deviation threshold in g
+	time_step : int
+		number of samples to subtract in each step
+
+	Returns
+	-------
+	start_slice : int
+		updated start of the non-wear time range
+	"""
+
+	# running sum and sum of squares of each column of the current range
+	sum_values, sum_squares = _sum_and_sum_squares(data, start_slice, end_slice)
+
+	while start_slice - time_step >= 0:
+
+		# sums of the samples that are added in this step
+		add_values, add_squares = _sum_and_sum_squares(data, start_slice - time_step, start_slice)
+
+		# stop when the extended range is not non-wear time anymore
+		if not _is_low_std(sum_values + add_values, sum_squares + add_squares, end_slice - start_slice + time_step, std_max):
 			break
 
-	if verbose:
-		logging.info(f'New index : {index}, number of loops : {i}')
-	return index
+		# update the start slice and the running sums
+		start_slice -= time_step
+		sum_values += add_values
+		sum_squares += add_squares
+
+	return start_slice
+
+
+@njit(parallel = True, cache = True)
+def _search_low_std_episodes(acc_data, start_indexes, stop_indexes, hz, max_steps, std_threshold):
+	"""
+	When we have episodes, these were created on a minute resolution, here we do a backward search from the start and a forward search from the stop of each episode to find 
+	the edges of the episodes with a second resolution. The episodes are independent, so they are processed in parallel
+
+	Parameters
+	----------
+	acc_data : np.array(samples, axes)
+		numpy array with acceleration data
+	start_indexes : np.array(episodes)
+		start index of each episode
+	stop_indexes : np.array(episodes)
+		stop index of each episode
+	hz : int
+		sample frequency of the data, the number of samples in a 1 second step
+	max_steps : int
+		maximum number of steps in each direction
+	std_threshold : int or float
+		the standard deviation threshold in g
 
-def _backward_search_episode(acc_data, index, hz, max_search_min, std_threshold, verbose = False):
+	Returns
+	-------
+	new_start_indexes : np.array(episodes)
+		extended start index of each episode
+	new_stop_indexes : np.array(episodes)
+		extended stop index of each episode
 	"""
-	When we have an episode, this was created on a minute resolution, here we do a backward search to find the edges of the episode with a second resolution
+
+	new_start_indexes = np.empty_like(start_indexes)
+	new_stop_indexes = np.empty_like(stop_indexes)
+
+	for e in prange(start_indexes.shape[0]):
+
+		new_start_indexes[e] = _search_low_std_seconds(acc_data, start_indexes[e], -hz, max_steps, std_threshold)[0]
+		new_stop_indexes[e] = _search_low_std_seconds(acc_data, stop_indexes[e], hz, max_steps, std_threshold)[0]
+
+	return new_start_indexes, new_stop_indexes
+
+
+@njit(cache = True, fastmath = True)
+def _search_low_std_seconds(acc_data, index, step, max_steps, std_threshold):
 	"""
+	Move the index with steps of one second (forward if step is positive, backward if step is negative) as long as the standard deviation of each column of the second 
+	that is added is below or equal to the standard deviation threshold
 
-	# calculate min slice index
-	min_slice_index = 0
+	Parameters
+	----------
+	acc_data : np.array(samples, axes)
+		numpy array with acceleration data
+	index : int
+		index to start the search from
+	step : int
+		number of samples in one second, negative to search backward
+	max_steps : int
+		maximum number of steps
+	std_threshold : int or float
+		the standard deviation threshold in g
 
-	for i in range(hz * 60 * max_search_min):
+	Returns
+	-------
+	index : int
+		updated index
+	i : int
+		number of the step in which the search stopped
+	"""
 
-		# create new slices
-		new_start_slice = index - hz
-		new_stop_slice = index
+	i = 0
+	for i in range(max_steps):
 
-		if verbose:
-			logging.info(f'i : {i}, new_start_slice : {new_start_slice}, new_stop_slice : {new_stop_slice}')
+		# define the start and stop of the second that is added
+		start = min(index, index + step)
+		stop = max(index, index + step)
 
-		# check if the new start slice exceeds the max_slice_index
-		if new_start_slice < min_slice_index:
-			if verbose:
-				logging.debug(f'Minimum slice index reached : {min_slice_index}')
+		# check if the start or stop exceeds the data
+		if start < 0 or stop > acc_data.shape[0]:
 			break
-			
-		# slice out new activity data
-		slice_data = acc_data[new_start_slice:new_stop_slice]
 
-		# calculate the standard deviation of each column (YXZ)
-		std = np.std(slice_data, axis=0)
-		
 		# check if all of the standard deviations are below the standard deviation threshold
-		if np.all(std <= std_threshold):
-			
-			# update index
-			index = new_start_slice
-		else:
+		if not _is_low_std_range(acc_data, start, stop, std_threshold):
 			break
 
-	if verbose:
-		logging.info(f'New index : {index}, number of loops : {i}')
-	return index
+		# update index
+		index += step
+
+	return index, i
+
+
+@njit(cache = True, fastmath = True)
+def _is_low_std_range(data, start, stop, std_threshold):
+	"""
+	Check if the standard deviation of each column of data[start:stop] is below or equal to the threshold. The columns are checked one by one, so the remaining 
+	columns are not read as soon as a column exceeds the threshold
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+	start : int
+		start index
+	stop : int
+		stop index (not included)
+	std_threshold : int or float
+		the standard deviation threshold in g
+
+	Returns
+	-------
+	low_std : Boolean
+		True if the standard deviation of all columns is below or equal to the threshold
+	"""
+
+	# the variance is compared to the squared threshold, so no square root is needed
+	var_threshold = std_threshold * std_threshold
+	n = stop - start
+
+	for j in range(data.shape[1]):
+
+		# running sum and sum of squares of the column
+		s1 = 0.0
+		s2 = 0.0
+		for i in range(start, stop):
+			value = float(data[i, j])
+			s1 += value
+			s2 += value * value
+
+		# stop as soon as a column exceeds the threshold
+		mean = s1 / n
+		if s2 / n - mean * mean > var_threshold:
+			return False
+
+	return True
+
+
+@njit(cache = True, fastmath = True)
+def _sum_and_sum_squares(data, start, stop):
+	"""
+	Calculate the sum and sum of squares of each column of data[start:stop] with double precision
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+	start : int
+		start index
+	stop : int
+		stop index (not included)
+
+	Returns
+	-------
+	sum_values : np.array(axes)
+		sum of each column
+	sum_squares : np.array(axes)
+		sum of squares of each column
+	"""
+
+	sum_values = np.zeros(data.shape[1])
+	sum_squares = np.zeros(data.shape[1])
+
+	for j in range(data.shape[1]):
+		for i in range(start, stop):
+			value = float(data[i, j])
+			sum_values[j] += value
+			sum_squares[j] += value * value
+
+	return sum_values, sum_squares
+
+
+@njit(cache = True, fastmath = True)
+def _is_low_std(sum_values, sum_squares, n, std_threshold):
+	"""
+	Check if the standard deviation of all columns, derived from the sum and sum of squares (var = E[x^2] - E[x]^2), is below or equal to the threshold
+
+	Parameters
+	----------
+	sum_values : np.array(axes)
+		sum of each column
+	sum_squares : np.array(axes)
+		sum of squares of each column
+	n : int
+		number of samples
+	std_threshold : int or float
+		the standard deviation threshold in g
+
+	Returns
+	-------
+	low_std : Boolean
+		True if the standard deviation of all columns is below or equal to the threshold
+	"""
+
+	# the variance is compared to the squared threshold, so no square root is needed
+	var_threshold = std_threshold * std_threshold
+
+	for j in range(sum_values.shape[0]):
+
+		mean = sum_values[j] / n
+		if sum_squares[j] / n - mean * mean > var_threshold:
+			return False
 
+	return True
+
+
+def _as_contiguous_float32(data):
+	"""
+	Convert acceleration data to an aligned float32 array that is contiguous in memory, either C order (samples contiguous) or Fortran order (each axis contiguous). Data that is 
+	sliced with a step or from a larger array (e.g. data[::2] or a subset of the columns) is copied into a new C ordered array, so the calculations do not have to stride through memory
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+
+	Returns
+	-------
+	data : np.array(samples, axes)
+		aligned and contiguous float32 numpy array with acceleration data (the same array if the data already satisfied this)
+	"""
+
+	# convert to aligned float32 data (no copy if this is already the case)
+	data = np.require(data, dtype = np.float32, requirements = ['A'])
+
+	# keep a C or Fortran ordered array, otherwise create a C ordered copy
+	if not (data.flags.c_contiguous or data.flags.f_contiguous):
+		data = np.ascontiguousarray(data)
+
+	return data
+
+
+def _as_contiguous(data):
+	"""
+	Convert acceleration data to an array that is contiguous in memory (see _as_contiguous_float32). Integer data, such as the raw values of a .gt3x file, keeps its data type, since the standard 
+	deviation calculations convert every value to double precision anyway, and raw int16 data is half the size of float32 data
+
+	Parameters
+	----------
+	data : np.array(samples, axes)
+		numpy array with acceleration data
+
+	Returns
+	-------
+	data : np.array(samples, axes)
+		contiguous integer or float32 numpy array with acceleration data (the same array if the data already satisfied this)
+	"""
+
+	# other data types are converted to float32
+	if not np.issubdtype(data.dtype, np.integer):
+		return _as_contiguous_float32(data)
+
+	# plain numpy array (also for memory-mapped data)
+	data = np.asarray(data)
+
+	# keep a C or Fortran ordered array, otherwise create a C ordered copy
+	if not (data.flags.c_contiguous or data.flags.f_contiguous):
+		data = np.ascontiguousarray(data)
+
+	return data
+
+
+@functools.lru_cache(maxsize = 4)
+def _load_cnn_model(cnn_model_file):
+	"""
+	Load a trained Keras CNN model. The loaded models are cached, so loading the same file again (for instance when processing many files) returns the
+	already loaded model instead of reading the file and building the model again
+
+	Parameters
+	----------
+	cnn_model_file : os.path
+		file location of the trained CNN model
+
+	Returns
+	--------
+	cnn_model : tf.keras.Model
+		loaded Keras model
+	"""
+
+	# load CNN model, the model is only used for inference, so it does not need to be compiled (this skips restoring the optimizer and loss)
+	return models.load_model(cnn_model_file, compile = False)
+
+
+@functools.lru_cache(maxsize = 4)
+def _get_cnn_classifier(cnn_model):
+	"""
+	Create a TensorFlow graph function that infers the binary class of features with a Keras CNN model. The function has a static input signature (any number of 
+	features with the input shape of the model), so it is traced only once, and it is cached for each model
+
+	Parameters
+	----------
+	cnn_model : tf.keras.Model
+		Keras model with a single sigmoid output
+
+	Returns
+	--------
+	classify : tf.function
+		function that returns the binary class (True for non-wear time) of a np.array(features, time, axes) as a tensor of shape (features, 1)
+	"""
+
+	@tf.function(input_signature = [tf.TensorSpec(shape = cnn_model.input_shape, dtype = tf.float32)])
+	def classify(features):
+		# the model has a single sigmoid output, so the class is 1 (non-wear time) if the probability is above 0.5 (this is what the deprecated, and in newer TensorFlow versions removed, predict_classes did)
+		return cnn_model(features, training = False) > 0.5
+
+	return classify
+
+
+def _get_tflite_model(cnn_model_file, representative_features = None):
+	"""
+	Get the file location of the TensorFlow Lite version of a trained CNN model. If it does not exist yet, the Keras model is converted and saved
+	to the same folder with a .tflite extension
+
+	Parameters
+	----------
+	cnn_model_file : os.path
+		file location of the trained CNN model
+	representative_features : np.array(features, time, axes) or list of np.array(time, axes) (optional)
+		if given, the weights and activations of the model are quantized to int8 and the features are used to calibrate the quantization. The quantized
+		model is saved with a _int8.tflite extension. Note that once the quantized model exists, it is not calibrated again.
+
+	Returns
+	--------
+	tflite_model_file : os.path
+		file location of the TensorFlow Lite model
+	"""
+
+	# the TensorFlow Lite model is stored next to the Keras model
+	tflite_model_file = os.path.splitext(cnn_model_file)[0] + ('.tflite' if representative_features is None else '_int8.tflite')
+
+	# convert the Keras model if this has not been done before
+	if not os.path.exists(tflite_model_file):
+
+		logger.info('Converting CNN model %s to TensorFlow Lite model %s', cnn_model_file, tflite_model_file)
+
+		# create the converter
+		converter = tf.lite.TFLiteConverter.from_keras_model(_load_cnn_model(cnn_model_file))
+
+		# full integer quantization of the model
+		if representative_features is not None:
+			converter.optimizations = [tf.lite.Optimize.DEFAULT]
+			converter.representative_dataset = lambda: ([feature[np.newaxis].astype(np.float32)] for feature in representative_features)
+			converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+			converter.inference_input_type = tf.int8
+
+		# convert the model
+		tflite_model = converter.convert()
+
+		# save to disk, the model is written to a temporary file in the same folder first and then renamed, so other processes that use the model at the same time (e.g. examples.py)
+		# never read a partially written file
+		file_descriptor, temporary_file = tempfile.mkstemp(suffix = '.tmp', dir = os.path.dirname(tflite_model_file) or '.')
+		with os.fdopen(file_descriptor, 'wb') as f:
+			f.write(tflite_model)
+		os.replace(temporary_file, tflite_model_file)
+
+	return tflite_model_file
+
+
+@functools.lru_cache(maxsize = 4)
+def _get_tflite_interpreter(tflite_model_file):
+	"""
+	Create a TensorFlow Lite interpreter for a model. The interpreters are cached, so the model is loaded and its tensors are allocated only once for each file 
+	instead of for every call. Note that an interpreter can not be used by several threads at the same time
+
+	Parameters
+	----------
+	tflite_model_file : os.path
+		file location of the TensorFlow Lite model
+
+	Returns
+	--------
+	interpreter : tf.lite.Interpreter
+		interpreter with allocated tensors that uses all available cores
+	"""
+
+	# create interpreter that uses all available cores
+	interpreter = tf.lite.Interpreter(model_path = tflite_model_file, num_threads = os.cpu_count())
+	interpreter.allocate_tensors()
+
+	return interpreter
+
+
+def _predict_classes_tflite(tflite_model_file, features):
+	"""
+	Infer the binary class of features with a TensorFlow Lite model, this is the equivalent of Keras' predict_classes for a model with a single sigmoid output
+
+	Parameters
+	----------
+	tflite_model_file : os.path
+		file location of the TensorFlow Lite model
+	features : np.array(num features, time, axes)
+		numpy array with features to classify
+
+	Returns
+	--------
+	labels : np.array(num features, 1)
+		binary class of each feature
+	"""
 
+	# get the interpreter of the model (only created the first time this file is used)
+	interpreter = _get_tflite_interpreter(tflite_model_file)
+
+	# get the input and output tensor of the model
+	input_details = interpreter.get_input_details()[0]
+	output_details = interpreter.get_output_details()[0]
+
+	# resize the input tensor so all features are classified in a single call, the tensors are only allocated again when the number of features differs from the previous call
+	if tuple(input_details['shape']) != features.shape:
+		interpreter.resize_tensor_input(input_details['index'], features.shape)
+		interpreter.allocate_tensors()
+		input_details = interpreter.get_input_details()[0]
+		output_details = interpreter.get_output_details()[0]
+
+	# quantize the features if the model has a quantized input
+	if input_details['dtype'] != np.float32:
+		scale, zero_point = input_details['quantization']
+		dtype_info = np.iinfo(input_details['dtype'])
+		features = np.clip(np.round(features / scale + zero_point), dtype_info.min, dtype_info.max)
+
+	# infer the probabilities
+	interpreter.set_tensor(input_details['index'], features.astype(input_details['dtype'], copy = False))
+	interpreter.invoke()
+	probabilities = interpreter.get_tensor(output_details['index'])
+
+	# dequantize the probabilities if the model has a quantized output
+	if output_details['dtype'] != np.float32:
+		scale, zero_point = output_details['quantization']
+		probabilities = (probabilities.astype(np.float32) - zero_point) * scale
+
+	# convert probabilities to binary class
+	return (probabilities > 0.5).astype('int32')
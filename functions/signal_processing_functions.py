@@ -15,6 +15,9 @@ except ImportError:
     Parallel = None
     delayed = None
 
+# module level logger, messages are formatted lazily so suppressed levels do not pay for string formatting
+logger = logging.getLogger(__name__)
+
 
 def apply_butterworth_filter(data, n, wn, btype, hz):
 	"""
@@ -45,7 +48,7 @@ def apply_butterworth_filter(data, n, wn, btype, hz):
 		numpy array with filtered acceleration data
 	"""
 
-	logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+	logger.info('Start %s', sys._getframe().f_code.co_name)
 
 	# create new numpy array to populate with the filtered data
 	data_filtered = np.empty(data.shape)
@@ -96,7 +99,7 @@ def resample_acceleration(data, from_hz, to_hz, use_parallel = False, num_jobs =
 		new numpy array with resampled acceleration data
 	"""
 
-	logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+	logger.info('Start %s', sys._getframe().f_code.co_name)
 
 	# calculate number of 1 sec samples (note that hz is the frequency per second)
 	num_seconds = len(data) // from_hz
@@ -107,8 +110,8 @@ def resample_acceleration(data, from_hz, to_hz, use_parallel = False, num_jobs =
 	# get number of axes in the data. These are the columns of the array (so if we have xyz then this is 3)
 	axes = data.shape[1]
 
-	# create new empty array that we can populate with the resampled data
-	new_data = np.zeros((num_samples, axes))
+	# create new empty array that we can populate with the resampled data. Data that is float32 (or integers) is kept in float32, so it is not converted back from float64 afterwards
+	new_data = np.zeros((num_samples, axes), dtype = np.result_type(data.dtype, np.float32))
 
 	if use_parallel:
 		
@@ -161,6 +164,6 @@ def resample(data, from_hz, to_hz, index, verbose):
 	"""
 
 	if verbose:
-		logging.debug('Processing axis {}'.format(index))
+		logger.debug('Processing axis %s', index)
 
 	return index, resampy.resample(data, from_hz, to_hz)
\ No newline at end of file
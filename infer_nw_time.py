@@ -1,13 +1,16 @@
 # import packages
 import os
+import json
+from logging import DEBUG
 import numpy as np
 import pandas as pd
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 # import functions
 from functions.helper_functions import set_start, set_end, read_directory, create_directory, save_csv
-from functions.raw_non_wear_functions import cnn_nw_algorithm
-from gt3x import create_time_array, rescale_log_data, extract_info
+from functions.raw_non_wear_functions import cnn_nw_algorithm, load_cnn_model
+from functions.gt3x_functions import get_sample_timestamps
 
 def parse_arguments():
 	"""
@@ -28,6 +31,42 @@ def parse_arguments():
 	return parser.parse_args()
 
 
+def prepare_data(file):
+	"""
+	Read the raw acceleration data, time data, and meta data that was extracted from a .gt3x file (see read_raw_gt3x.py)
+
+	Parameters
+	-----------
+	file : os.path
+		file location of the raw_data.npy file. The time_data.npy and meta_data.json files are expected in the same folder
+
+	Returns
+	--------
+	actigraph_acc : np.array((n_samples, 3))
+		raw acceleration data as stored in the .gt3x file (integers, memory-mapped), the data is converted to g values with the acceleration scale in the meta data
+	actigraph_time : np.array(n_seconds, 1)
+		unix timestamp of each second of acceleration data (memory-mapped)
+	meta_data : dict
+		meta data of the .gt3x file
+	"""
+
+	# folder where the raw data, time data, and meta data of the file are stored
+	folder = os.path.dirname(file)
+
+	# read raw acceleration data as a memory-map, so the data is read from disk when it is needed instead of being loaded into memory at once. The data is kept as raw integers, the non-wear
+	# algorithm finds the candidate non-wear episodes on the raw values and only converts the features of the CNN model to g values, so no float copy of the full data has to be created
+	actigraph_acc = np.load(file, mmap_mode = 'r')
+
+	# read meta data from file
+	with open(os.path.join(folder, 'meta_data.json'), 'r') as f:
+		meta_data = json.load(f)
+
+	# extract time data as a memory-map. The timestamps of individual samples are only created for the start and stop of the non-wear episodes, so no time array of all samples is needed
+	actigraph_time = np.load(os.path.join(folder, 'time_data.npy'), mmap_mode = 'r')
+
+	return actigraph_acc, actigraph_time, meta_data
+
+
 
 """
 	SCRIPT STARTS HERE
@@ -54,7 +93,7 @@ if __name__ == "__main__":
 	# logical operator to see if both sides need to be classified as non-wear time (AND) or just a single side (OR)
 	start_stop_label_decision = 'and'
 
-	# load cnn model
+	# file location of the cnn model
 	cnn_model_file = os.path.join('cnn_models', f'cnn_v2_{str(episode_window_sec)}.h5')
 
 	"""
@@ -63,35 +102,38 @@ if __name__ == "__main__":
 	# check if folder argument is provided
 	if args.folder is not None:
 
-		# read all numpy files in folder argument
-		F = [f for f in read_directory(args.folder) if f[-4:] == '.npz']
+		# read all raw acceleration numpy files in folder argument
+		F = list(read_directory(args.folder, pattern = 'raw_data.npy'))
+
+		logging.info('Found %s raw acceleration files to process', len(F))
+
+		# load cnn model once, the same model is used for all files
+		cnn_model = load_cnn_model(cnn_model_file)
+
+		# the data of the next file is read and prepared in a background thread while the non-wear time of the current file is inferred. Only one file is read ahead, so at most two files are kept in memory
+		executor = ThreadPoolExecutor(max_workers = 1)
 
-		logging.info(f'Found {len(F)} raw acceleration files to process')
+		# start reading the first file
+		next_data = executor.submit(prepare_data, F[0]) if len(F) > 0 else None
 
 		# process each file
 		for i, file in enumerate(F):
 
-			logging.info(f'Processing file {file} {i}/{len(F)}')
+			logging.info('Processing file %s %s/%s', file, i, len(F))
 
 			"""
 				PREPARE DATA
 			"""
 
-			# read file as numpy array
-			data = np.load(file)
-			# extract raw acceleration data from numpy.
-			actigraph_acc = data['raw_data']
+			# folder where the raw data, time data, and meta data of the file are stored
+			folder = os.path.dirname(file)
 
-			# read meta data from file
-			meta_data = data['meta_data']
+			# wait until the data of the current file is read
+			actigraph_acc, actigraph_time, meta_data = next_data.result()
 
-			# convert acceleration values to g values
-			actigraph_acc = rescale_log_data(log_data = actigraph_acc, acceleration_scale = meta_data['Acceleration_Scale'])
-
-			# extract time data 
-			actigraph_time = data['time_data']
-			# convert time data to correct time series array with correct miliseconds values
-			actigraph_time = create_time_array(actigraph_time, hz = int(meta_data['Sample_Rate']))
+			# start reading the next file while the current file is processed
+			if i + 1 < len(F):
+				next_data = executor.submit(prepare_data, F[i + 1])
 			
 			"""
 				INFER NON-WEAR TIME
@@ -99,29 +141,31 @@ if __name__ == "__main__":
 			# call function to infer non-wear time
 			nw_vector, nw_data = cnn_nw_algorithm(	raw_acc = actigraph_acc,
 													hz = int(meta_data['Sample_Rate']),
-													cnn_model_file = cnn_model_file, 
+													cnn_model_file = cnn_model,
 													std_threshold = std_threshold,
 													distance_in_min = distance_in_min,
 													episode_window_sec = episode_window_sec,
 													edge_true_or_false = edge_true_or_false,
-													start_stop_label_decision = start_stop_label_decision
+													start_stop_label_decision = start_stop_label_decision,
+													acceleration_scale = float(meta_data['Acceleration_Scale'])
 													)
 			
 			"""
 				POST PROCESS DATA
 			"""
 
-			# convert nw_indexes to timestamps
-			nw_data_timestamps = []
-			for row in nw_data:
-				# get start timestamps
-				start_timestamp = actigraph_time[row[0]]
-				# get stop timestamps
-				stop_timestamp = actigraph_time[row[1]]
-				# verbose
-				logging.info(f'Found non wear episode at Start : {start_timestamp}, Stop : {stop_timestamp}')
-				# add to list
-				nw_data_timestamps.append([start_timestamp, stop_timestamp])
+			# convert the start and stop indexes to a numpy array with one row per non-wear episode (also when no non-wear episodes were found)
+			nw_data = np.asarray(nw_data, dtype = np.int64).reshape(-1, 2)
+
+			# convert nw_indexes to timestamps by calculating all start and stop timestamps at once. The timestamps are converted to strings so they are saved in the same (ISO) format as the timestamps themselves
+			nw_data_timestamps = get_sample_timestamps(actigraph_time, nw_data, hz = int(meta_data['Sample_Rate'])).astype(str)
+
+			# verbose, log the number of non-wear episodes
+			logging.info('Found %s non wear episodes', len(nw_data_timestamps))
+
+			# log all non-wear episodes with a single call on debug level (long recordings can have many episodes), the message is only created if debug messages are logged
+			if len(nw_data_timestamps) > 0 and logging.isEnabledFor(DEBUG):
+				logging.debug('Non wear episodes:\n%s', '\n'.join(f'Start : {start_timestamp}, Stop : {stop_timestamp}' for start_timestamp, stop_timestamp in nw_data_timestamps.tolist()))
 
 			"""
 				SAVE DATA
@@ -131,12 +175,15 @@ if __name__ == "__main__":
 			logging.info('Saving data to disk')
 
 			# save non-wear vector as numpy array
-			np.save(file = os.path.join(os.path.dirname(file), 'nw_vector'), arr = nw_vector)
+			np.save(file = os.path.join(folder, 'nw_vector'), arr = nw_vector)
 			# save start and stop indexes
-			save_csv(data = nw_data, name = 'non_wear_data_indexes', folder = os.path.dirname(file))
+			save_csv(data = nw_data, name = 'non_wear_data_indexes', folder = folder)
 			# save human readable start and stop timestamps as CSV file
-			save_csv(data = nw_data_timestamps, name = 'non_wear_data_timestamps', folder = os.path.dirname(file))
+			save_csv(data = nw_data_timestamps, name = 'non_wear_data_timestamps', folder = folder)
 		
+		# stop the background thread
+		executor.shutdown()
+
 	else:
 		logging.warning('Folder argument not provided. Please specify the -fd or --folder argument which specifies where raw acceleration data is stored in numpy format.')
 
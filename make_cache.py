@@ -0,0 +1,92 @@
+"""
+Compile the numba functions of the non-wear algorithms and store them in the numba cache (the __pycache__ folders next to the modules), so the first file that is
+processed does not pay for the compilation. Run this script once after installing or updating the code, for example when building a deployment image.
+
+The kernels that decode the log.bin file in read_raw_gt3x.py have fixed argument types and are compiled when functions.gt3x_functions is imported. The non-wear
+algorithms are compiled for each combination of argument types, so they are called with the same data types and memory layouts as infer_nw_time.py and examples.py
+use them (float32 acceleration data in C and Fortran order, and the read-only raw int16 data that infer_nw_time.py passes to the CNN non-wear algorithm).
+"""
+
+# import packages
+import os
+import numpy as np
+
+# import functions
+from functions.helper_functions import set_start, set_end, calculate_vector_magnitude
+from functions.gt3x_functions import rescale_log_data
+from functions.raw_non_wear_functions import cnn_nw_algorithm, find_candidate_non_wear_segments_from_raw, hees_2013_calculate_non_wear_time, raw_baseline_calculate_non_wear_time
+
+def create_dummy_data(hz = 100, num_minutes = 90):
+	"""
+	Create raw triaxial acceleration data (as stored in a .gt3x file) with non-wear time (no movement) in the middle and wear time (movement) before and after, so all steps of the 
+	non-wear algorithms are executed
+
+	Parameters
+	-----------
+	hz : int (optional)
+		sample frequency of the data
+	num_minutes : int (optional)
+		length of the data in minutes
+
+	Returns
+	--------
+	raw_data : np.array((num_minutes * 60 * hz, 3))
+		raw acceleration data (int16) with a scale of 256 LSB/g
+	"""
+
+	# movement with a standard deviation of about 0.05 g
+	raw_data = np.random.default_rng(0).normal(0, 13, size = (num_minutes * 60 * hz, 3)).astype(np.int16)
+
+	# no movement in the middle third of the data, the device lies flat (1 g on the last axis)
+	raw_data[len(raw_data) // 3 : 2 * len(raw_data) // 3] = [0, 0, 256]
+
+	return raw_data
+
+
+"""
+	SCRIPT STARTS HERE
+"""
+if __name__ == "__main__":
+
+	# set the logger and start time
+	tic, process, logging = set_start()
+
+	# sample frequency of the data
+	hz = 100
+	# path for trained CNN model
+	cnn_model_file = os.path.join('cnn_models', 'cnn_v2_7.h5')
+
+	# raw acceleration data
+	raw_data = create_dummy_data(hz = hz)
+
+	# importing functions.gt3x_functions above already compiled the decoding of the log.bin file (its kernels have fixed argument types and are compiled when the module is imported)
+
+	# compile for acceleration data with the samples stored contiguously (C) and with the axes stored contiguously (F)
+	for order in ['C', 'F']:
+
+		logging.info('Compiling numba functions for %s ordered data', order)
+
+		# convert acceleration values to g values
+		raw_acc = rescale_log_data(log_data = raw_data, acceleration_scale = 256., order = order)
+
+		# ENMO
+		calculate_vector_magnitude(raw_acc, minus_one = True, round_negative_to_zero = True)
+
+		# candidate non-wear segments of the individual axes and the VMU
+		for use_vmu in [False, True]:
+			find_candidate_non_wear_segments_from_raw(raw_acc, std_threshold = 0.004, hz = hz, use_vmu = use_vmu)
+			raw_baseline_calculate_non_wear_time(raw_acc, std_threshold = 0.004, min_interval = 30, hz = hz, use_vmu = use_vmu)
+
+		# v. Hees non-wear algorithm
+		hees_2013_calculate_non_wear_time(raw_acc, hz = hz)
+
+		# CNN non-wear algorithm (this also searches the edges of the non-wear episodes)
+		cnn_nw_algorithm(raw_acc, hz = hz, cnn_model_file = cnn_model_file)
+
+	# CNN non-wear algorithm on the raw int16 data (as used by infer_nw_time.py). infer_nw_time.py memory-maps the data read-only, and numba compiles separate versions for read-only arrays
+	logging.info('Compiling numba functions for raw int16 data')
+	raw_data.flags.writeable = False
+	cnn_nw_algorithm(raw_data, hz = hz, cnn_model_file = cnn_model_file, acceleration_scale = 256.)
+
+	# verbose
+	set_end(tic, process)
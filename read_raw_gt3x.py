@@ -1,5 +1,6 @@
 # import packages
 import os
+import json
 import numpy as np
 from argparse import ArgumentParser
 
@@ -10,6 +11,7 @@ from joblib import delayed
 
 # import functions
 from functions.helper_functions import set_start, set_end, read_directory, create_directory
+from functions.gt3x_functions import unzip_gt3x_file, extract_info, extract_log
 from gt3x import read_gt3x
 
 def parse_arguments():
@@ -34,6 +36,8 @@ def parse_arguments():
 	parser.add_argument('-dz', '--delete_zip', dest = 'delete_zip_file', action='store_true', help = 'When the .gt3x files is unzipped, it creates a log.bin data. This file contains the raw acceleration data. After this data has been converted to a numpy array, it can be deleted by provided this argument.')
 	# use parallel processing
 	parser.add_argument('-up', '--use_parallel', dest = 'use_parallel', action = 'store_true', help = 'When this argument is given, all .gt3x files will be processed in parallel.')
+	# use processes instead of threads for parallel processing
+	parser.add_argument('-cb', '--cpu_bound', dest = 'cpu_bound', action = 'store_true', help = 'When this argument is given together with --use_parallel, the .gt3x files are processed in parallel processes instead of threads (one per cpu core). Use this for older .gt3x files with an activity.bin file, these are decoded by the gt3x package in Python code that can not run in parallel threads.')
 
 	# parse out the arguments and return
 	return parser.parse_args()
@@ -44,7 +48,7 @@ def process_gt3x_file(idx, total, file, save_folder, delete_source_file, delete_
 		1: unzip .gt3x to get the log.bin and info.txt file and save to disk
 		2: read info.txt file and parse the content to a dictionary
 		3: extract raw acceleration data from the log.bin binary file
-		4: save all data to disk
+		4: save all data to disk (raw_data.npy, time_data.npy, and meta_data.json)
 
 
 	Parameters
@@ -60,7 +64,7 @@ def process_gt3x_file(idx, total, file, save_folder, delete_source_file, delete_
 	
 	"""
 
-	logging.info(f'Processing file {file} {idx + 1}/{total}')
+	logging.info('Processing file %s %s/%s', file, idx + 1, total)
 
 	# extract name for subfolder based on file name without extension
 	subfolder = os.path.splitext(file)[0].split(os.sep)[-1]
@@ -73,27 +77,51 @@ def process_gt3x_file(idx, total, file, save_folder, delete_source_file, delete_
 
 	
 	# unzip .gt3x file and get the file location of the binary log.bin (which contains the raw data) and the info.txt which contains the meta-data
-	# log_bin, info_txt = unzip_gt3x_file(f = file, save_location = save_folder, delete_source_file = delete_source_file)
+	log_bin, info_txt = unzip_gt3x_file(f = file, save_location = save_folder, delete_source_file = delete_source_file)
 
-	# # get meta data from info.txt file
-	# meta_data = extract_info(info_txt)
+	# unzip_gt3x_file logs the error if the file could not be unzipped
+	if log_bin is None:
+		return
 
-	# # read raw data from binary data
-	# log_data, time_data = extract_log(log_bin = log_bin, acceleration_scale = float(meta_data['Acceleration_Scale']), sample_rate = int(meta_data['Sample_Rate']), use_scaling = False)
+	# get meta data from info.txt file
+	meta_data = extract_info(info_txt)
 
-	# if 'delete_zip_file' is set to True, then remove the unpacked log.bin data
-	# if delete_zip_file:
-	# 	os.remove(log_bin)
+	# older devices do not store the acceleration scale in the info.txt file, they use a scale of 341 LSB/g
+	if 'Acceleration_Scale' not in meta_data:
+		meta_data['Acceleration_Scale'] = 341.
 
-	"""
-		The following code will use the package gt3x which contains updated code for older .gt3x formats. In case you want to use the functions within this repo, please use the above lines
-		which are now uncommented.
-	"""
+	if os.path.exists(log_bin):
+
+		# read raw data from binary data
+		log_data, time_data = extract_log(log_bin = log_bin, acceleration_scale = float(meta_data['Acceleration_Scale']), sample_rate = int(meta_data['Sample_Rate']), use_scaling = False)
 
-	log_data, time_data, meta_data = read_gt3x(f = file, save_location = save_folder, create_time = False, rescale_data = False, verbose = False)
+		# the data is stored in the log.bin format
+		meta_data['old_format'] = False
+
+		# if 'delete_zip_file' is set to True, then remove the unpacked log.bin data
+		if delete_zip_file:
+			os.remove(log_bin)
+
+	else:
 
-	# save log_data and time_data as numpy array
-	np.savez(file = os.path.join(save_folder, subfolder), raw_data = log_data, time_data = time_data, meta_data = meta_data)
+		"""
+			Older .gt3x files (e.g. NHANES) store the raw data in an activity.bin file instead of a log.bin file. These files are read with the package gt3x, which 
+			contains code for the older .gt3x formats. Since the file is already unzipped, the package reads the unzipped files from the save folder.
+		"""
+		log_data, time_data, meta_data = read_gt3x(f = file, save_location = save_folder, create_time = False, rescale_data = False, verbose = False)
+
+	# extract_log logs the error if the raw data could not be decoded
+	if log_data is None:
+		logging.error('Could not extract raw data from file %s', file)
+		return
+
+	# save log_data and time_data as separate uncompressed numpy arrays. Unlike a .npz archive, a .npy file can be read directly (or memory-mapped) without going through a zip file
+	np.save(file = os.path.join(save_folder, 'raw_data.npy'), arr = log_data)
+	np.save(file = os.path.join(save_folder, 'time_data.npy'), arr = time_data)
+
+	# save the meta data as a human readable JSON file
+	with open(os.path.join(save_folder, 'meta_data.json'), 'w') as f:
+		json.dump(meta_data, f, default = str)
 
 
 """
@@ -107,23 +135,32 @@ if __name__ == "__main__":
 	# pars command line arguments
 	args = parse_arguments()
 
-	# if --use_parallel is provided, set num_jobs to the number of cores
-	if args.use_parallel:
+	# if --use_parallel is provided, process the files in parallel threads. The raw data of a log.bin file is decoded by compiled code that does not hold the GIL (see extract_log), and unzipping and 
+	# saving the data release the GIL too, so the threads run in parallel on all cpu cores without forking processes and copying the results between them
+	if args.use_parallel and not args.cpu_bound:
+		# set number of jobs to number of cpu cores
+		num_jobs = cpu_count()
+		backend = 'threading'
+		logging.info('Parallel processing enabled. Using %s threads', num_jobs)
+	# if --cpu_bound is also provided, process the files in parallel processes instead. Older .gt3x files with an activity.bin file are decoded by the gt3x package in Python code, which holds the GIL
+	elif args.use_parallel:
 		# set number of jobs to number of cpu cores
 		num_jobs = cpu_count()
-		logging.info(f'Parallel processing enabled. Using {num_jobs} cores')
+		backend = 'multiprocessing'
+		logging.info('Parallel processing enabled. Using %s cores', num_jobs)
 	else:
 		num_jobs = 1
+		backend = 'threading'
 
 	# check if folder is sent as argument, if so, then process each file within that folder 
 	if args.folder is not None:
 		
 		# read all gt3x files within folder
-		F = [x for x in read_directory(args.folder) if x[-4:] == 'gt3x']
-		logging.info(f'Found a total of {len(F)} .gt3x files to process')
+		F = list(read_directory(args.folder, pattern = '*.gt3x'))
+		logging.info('Found a total of %s .gt3x files to process', len(F))
 
 		# use parallel processing to speed up processing time
-		executor = Parallel(n_jobs = num_jobs, backend = 'multiprocessing')
+		executor = Parallel(n_jobs = num_jobs, backend = backend)
 		# create tasks so we can execute them in parallel
 		tasks = (delayed(process_gt3x_file)(idx = i, total = len(F), file = f, save_folder = args.save_folder, delete_source_file = args.delete_source_file, delete_zip_file = args.delete_zip_file) for i, f in enumerate(F))
 		# execute task